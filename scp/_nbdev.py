@@ -94,12 +94,70 @@ index = {"threshold_argmax": "nb_analysis.binary.ipynb",
          "custom_save": "nb_utils.general.ipynb",
          "custom_load": "nb_utils.general.ipynb",
          "zip_dir": "nb_utils.general.ipynb",
-         "isnotebook": "nb_utils.general.ipynb"}
+         "isnotebook": "nb_utils.general.ipynb",
+         "ImageCache": "nb_data.dataset.ipynb",
+         "performance_curve": "nb_analysis.binary.ipynb",
+         "best_threshold": "nb_analysis.binary.ipynb",
+         "BinaryMetrics": "nb_analysis.binary.ipynb",
+         "flip_counts": "nb_projects.robustness_benchmark.ipynb",
+         "add_path_metadata": "nb_projects.robustness_benchmark.ipynb",
+         "BenchmarkRunner": "nb_projects.robustness_benchmark.ipynb",
+         "PredictionReader": "nb_inference.general.ipynb",
+         "sample_class_idxs": "nb_train.balance.ipynb",
+         "balance_idxs": "nb_train.balance.ipynb",
+         "group_by_class": "nb_train.balance.ipynb",
+         "BalancedSampler": "nb_data.sampler.ipynb",
+         "BatchTransform": "nb_train.best_practices.ipynb",
+         "BatchTranspose": "nb_train.best_practices.ipynb",
+         "BatchVerticalFlip": "nb_train.best_practices.ipynb",
+         "BatchHorizontalFlip": "nb_train.best_practices.ipynb",
+         "BatchRandomRotate90": "nb_train.best_practices.ipynb",
+         "BatchBrightnessContrast": "nb_train.best_practices.ipynb",
+         "BatchShiftScaleRotate": "nb_train.best_practices.ipynb",
+         "BatchCutout": "nb_train.best_practices.ipynb",
+         "BatchTransforms": "nb_train.best_practices.ipynb",
+         "reduction_factor": "nb_data.decoder.ipynb",
+         "read_img": "nb_data.decoder.ipynb",
+         "decode_opencv": "nb_data.decoder.ipynb",
+         "decode_pil": "nb_data.decoder.ipynb",
+         "decode_torchvision": "nb_data.decoder.ipynb",
+         "TurboJPEGDecoder": "nb_data.decoder.ipynb",
+         "get_decoder": "nb_data.decoder.ipynb",
+         "decoders": "nb_data.decoder.ipynb",
+         "benchmark_decoders": "nb_data.decoder.ipynb",
+         "benchmark_decoders_cli": "nb_data.decoder.ipynb",
+         "write_shards": "nb_data.shards.ipynb",
+         "read_shard_index": "nb_data.shards.ipynb",
+         "ShardReader": "nb_data.shards.ipynb",
+         "ShardedImageDataset": "nb_data.shards.ipynb",
+         "ShardedIterableImageDataset": "nb_data.shards.ipynb",
+         "ensemble_methods": "nb_analysis.utils.ipynb",
+         "bootstrap_ci": "nb_analysis.binary.ipynb",
+         "rank_auroc": "nb_analysis.binary.ipynb",
+         "delong_variance": "nb_analysis.binary.ipynb",
+         "delong_test": "nb_analysis.binary.ipynb",
+         "StreamingHook": "nb_utils.general.ipynb",
+         "EmbeddingStore": "nb_inference.embeddings.ipynb",
+         "extract_embeddings": "nb_inference.embeddings.ipynb",
+         "KNNIndex": "nb_inference.embeddings.ipynb",
+         "knn_accuracy": "nb_inference.embeddings.ipynb",
+         "linear_probe": "nb_inference.embeddings.ipynb",
+         "cache_vit_features": "nb_projects.self_supervised.ipynb",
+         "train_head_from_cache": "nb_projects.self_supervised.ipynb",
+         "benchmark_head_training": "nb_projects.self_supervised.ipynb",
+         "benchmark_mae_masking": "nb_projects.self_supervised.ipynb",
+         "CheckpointCache": "nb_projects.self_supervised.ipynb",
+         "EpochDataLoader": "nb_data.shards.ipynb",
+         "binary_metrics": "nb_projects.robustness_benchmark.ipynb"}
 
 modules = ["analysis/binary.py",
            "analysis/utils.py",
            "data/datamodule.py",
            "data/dataset.py",
+           "data/decoder.py",
+           "data/sampler.py",
+           "data/shards.py",
+           "inference/embeddings.py",
            "inference/general.py",
            "projects/robustness_benchmark.py",
            "projects/self_supervised.py",
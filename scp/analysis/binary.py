@@ -1,12 +1,15 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: nb_analysis.binary.ipynb (unless otherwise specified).
 
-__all__ = ['threshold_argmax', 'youdens_jstats', 'performance', 'auroc', 'specificity', 'sensitivity', 'accuracy',
-           'bal_accuracy', 'error_rate', 'bal_error_rate']
+__all__ = ['threshold_argmax', 'youdens_jstats', 'rank_auroc', 'delong_variance', 'delong_test', 'BinaryMetrics',
+           'performance', 'performance_curve', 'best_threshold', 'bootstrap_ci', 'auroc', 'specificity', 'sensitivity',
+           'accuracy', 'bal_accuracy', 'error_rate', 'bal_error_rate']
 
 # Cell
 import pandas as pd
 import numpy as np
-from sklearn.metrics import roc_auc_score, balanced_accuracy_score, confusion_matrix
+import math
+from statistics import NormalDist
+from concurrent.futures import ProcessPoolExecutor
 
 # Cell
 def threshold_argmax(y_score_1c, thresh:float=0.5):
@@ -30,7 +33,7 @@ def threshold_argmax(y_score_1c, thresh:float=0.5):
              Converted scores to integers between 0 and 1
 
     '''
-    y_pred = np.array([1 if score > thresh else 0 for score in y_score_1c])
+    y_pred = (np.asarray(y_score_1c) > thresh).astype(np.int64)
     return y_pred
 
 # Cell
@@ -54,6 +57,184 @@ def youdens_jstats(sens:float, spec:float):
     youden = sens + spec - 1
     return youden
 
+# Cell
+def _midranks(x):
+    '''1-based ranks of ´x´ where ties get their average rank (O(n log n))'''
+    _, inverse, counts = np.unique(x, return_inverse=True, return_counts=True)
+    return (np.cumsum(counts) - (counts - 1) / 2)[inverse.ravel()]
+
+def _split_scores(y_true, y_score_1c, labels):
+    '''Scores of positives and negatives with shape (number of models, number of samples)'''
+    y_true = np.asarray(y_true).ravel()
+    y_score_1c = np.atleast_2d(np.asarray(y_score_1c, dtype=np.float64))
+    return y_score_1c[:, y_true == labels[1]], y_score_1c[:, y_true == labels[0]]
+
+def _delong_components(pos_scores, neg_scores):
+    '''AUROCs and DeLong structural components of several models (Sun & Xu, 2014)'''
+    m, n = pos_scores.shape[1], neg_scores.shape[1]
+    v10, v01 = np.empty(pos_scores.shape), np.empty(neg_scores.shape)
+    for k, (pos, neg) in enumerate(zip(pos_scores, neg_scores)):
+        ranks = _midranks(np.concatenate([pos, neg]))
+        # fraction of negatives below every positive and of positives above every negative (ties count half)
+        v10[k] = (ranks[:m] - _midranks(pos)) / n
+        v01[k] = 1 - (ranks[m:] - _midranks(neg)) / m
+    return v10.mean(axis=1), v10, v01
+
+def rank_auroc(y_true, y_score_1c, labels:list=[0, 1]):
+    '''Area under the ROC curve computed from the ranks of the scores (Mann-Whitney U statistic) in O(n log n)
+
+    Same result as ´roc_auc_score´ (ties count half), but works on numpy arrays and (cpu) tensors directly
+    and returns NaN instead of raising if one of the classes is missing.
+
+    Parameters
+    ----------
+    y_true : 1d array-like
+             Ground truth (correct) target values
+
+    y_score_1c : 1d array-like of floats
+                 Target scores of the positive class (see ´performance´)
+
+    labels : list, default=[0, 1]
+             Negative and positive label in ´y_true´
+    '''
+    pos_scores, neg_scores = _split_scores(y_true, y_score_1c, labels)
+    m, n = pos_scores.shape[1], neg_scores.shape[1]
+    if m == 0 or n == 0:
+        return np.nan
+    ranks = _midranks(np.concatenate([pos_scores[0], neg_scores[0]]))
+    return (ranks[:m].sum() - m * (m + 1) / 2) / (m * n)
+
+def delong_variance(y_true, y_score_1c, labels:list=[0, 1], alpha:float=0.05):
+    '''AUROC with DeLong variance and the corresponding (normal approximation) confidence interval
+
+    Returns
+    -------
+    delong : dict
+             ´auroc´, ´var´ and the 1-´alpha´ confidence interval (´lower´, ´upper´, clipped to [0, 1])
+    '''
+    pos_scores, neg_scores = _split_scores(y_true, y_score_1c, labels)
+    if pos_scores.shape[1] < 2 or neg_scores.shape[1] < 2:
+        raise ValueError("DeLong variance requires at least two positives and two negatives")
+    aucs, v10, v01 = _delong_components(pos_scores, neg_scores)
+    var = v10[0].var(ddof=1) / v10.shape[1] + v01[0].var(ddof=1) / v01.shape[1]
+    delta = NormalDist().inv_cdf(1 - alpha / 2) * math.sqrt(var)
+    return {"auroc": aucs[0], "var": var, "lower": max(aucs[0] - delta, 0.), "upper": min(aucs[0] + delta, 1.)}
+
+def delong_test(y_true, y_score_1c_a, y_score_1c_b, labels:list=[0, 1]):
+    '''Paired DeLong test whether two models evaluated on the same test set have different AUROCs
+
+    Returns
+    -------
+    delong : dict
+             AUROCs of both models (´auroc_a´, ´auroc_b´), their difference (´diff´ = a - b),
+             the variance of the difference (´var´), the z-score (´z´) and the two-sided p-value (´p_value´)
+    '''
+    pos_scores, neg_scores = _split_scores(y_true, np.stack([np.asarray(y_score_1c_a).ravel(), np.asarray(y_score_1c_b).ravel()]), labels)
+    if pos_scores.shape[1] < 2 or neg_scores.shape[1] < 2:
+        raise ValueError("DeLong test requires at least two positives and two negatives")
+    aucs, v10, v01 = _delong_components(pos_scores, neg_scores)
+    cov = np.cov(v10) / v10.shape[1] + np.cov(v01) / v01.shape[1]
+    diff, var = aucs[0] - aucs[1], cov[0, 0] + cov[1, 1] - 2 * cov[0, 1]
+    if var <= 0: # identical predictions
+        z, p_value = 0., 1.
+    else:
+        z = diff / math.sqrt(var)
+        p_value = math.erfc(abs(z) / math.sqrt(2))
+    return {"auroc_a": aucs[0], "auroc_b": aucs[1], "diff": diff, "var": var, "z": z, "p_value": p_value}
+
+# Cell
+class BinaryMetrics():
+    '''Shared state to compute several metrics for a single binary classification prediction
+
+    Predictions are thresholded and the confusion matrix is computed once at initialization.
+    Every metric is derived from this shared state (AUROC from the scores) the first time it
+    is requested and cached afterwards, hence any subset of metrics can be served without
+    re-evaluating the prediction.
+
+    Parameters
+    ----------
+    y_true : 1d array-like
+             Ground truth (correct) target values
+
+    y_score_1c : 1d array-like of floats
+                 Target scores of the positive class (see ´performance´)
+
+    thresh : float, default=0.5
+             Treshold
+
+    labels : list, default=[0, 1]
+             Negative and positive label in ´y_true´
+
+    Attributes
+    ----------
+    tn, fp, fn, tp : int
+                     Entries of the confusion matrix
+    '''
+    metric_names = ["acc", "sens", "spec", "bal_acc", "youden", "auroc", "err_rate", "bal_err_rate"]
+
+    def __init__(self, y_true, y_score_1c, thresh:float=0.5, labels:list=[0, 1]):
+        self.y_true = np.asarray(y_true).ravel()
+        self.y_score_1c = np.asarray(y_score_1c).ravel()
+        self.thresh = thresh
+        self.labels = labels
+
+        y_pred = threshold_argmax(self.y_score_1c, thresh=thresh).astype(bool)
+        is_neg, is_pos = self.y_true == labels[0], self.y_true == labels[1]
+        self.tp = np.int64(np.count_nonzero(is_pos & y_pred))
+        self.fn = np.int64(np.count_nonzero(is_pos & ~y_pred))
+        self.fp = np.int64(np.count_nonzero(is_neg & y_pred))
+        self.tn = np.int64(np.count_nonzero(is_neg & ~y_pred))
+
+        self._metrics = dict()
+
+    @classmethod
+    def from_preds(cls, preds, **kwargs):
+        '''Create from fastai-style-like prediction i.e. tuple of two tensors like (probs, gt)
+
+        An existing ´BinaryMetrics´ is returned as is, hence the metric functions below can share one bundle.
+        '''
+        if isinstance(preds, cls):
+            if len(kwargs) > 0:
+                raise ValueError(f"Cannot apply {list(kwargs)} to an existing BinaryMetrics")
+            return preds
+        return cls(preds[1], preds[0][:,1], **kwargs)
+
+    def _compute(self, metric):
+        tn, fp, fn, tp = self.tn, self.fp, self.fn, self.tp
+        with np.errstate(divide="ignore", invalid="ignore"):
+            if metric == "acc":
+                return (tn+tp) / (tn+tp+fn+fp)
+            if metric == "sens":
+                return tp / (tp+fn)
+            if metric == "spec":
+                return tn / (tn+fp)
+        if metric == "bal_acc":
+            # same as sklearn's balanced accuracy, i.e. classes missing in y_true are ignored
+            recalls = [v for v in (self["sens"], self["spec"]) if not np.isnan(v)]
+            return np.mean(recalls) if len(recalls) > 0 else np.nan
+        if metric == "youden":
+            return youdens_jstats(self["sens"], self["spec"])
+        if metric == "auroc":
+            return rank_auroc(self.y_true, self.y_score_1c, labels=self.labels)
+        if metric == "err_rate":
+            return 1 - self["acc"]
+        if metric == "bal_err_rate":
+            return 1 - self["bal_acc"]
+        raise ValueError(f"Unknown metric {metric}")
+
+    def __getitem__(self, metric):
+        if metric not in self._metrics:
+            self._metrics[metric] = self._compute(metric)
+        return self._metrics[metric]
+
+    def compute(self, *metrics):
+        '''Get a dict with the requested metrics (all metrics if none are given)'''
+        metrics = metrics if len(metrics) > 0 else self.metric_names
+        return {metric: self[metric] for metric in metrics}
+
+    def __repr__(self):
+        return f"BinaryMetrics(tn={self.tn}, fp={self.fp}, fn={self.fn}, tp={self.tp}, thresh={self.thresh})"
+
 # Cell
 def performance(y_true, y_score_1c, thresh=0.5, labels:list=[0, 1],
                 bal_acc:bool=False, youden:bool=False, auroc:bool=False, err_rate:bool=False, bal_err_rate:bool=False):
@@ -88,64 +269,221 @@ def performance(y_true, y_score_1c, thresh=0.5, labels:list=[0, 1],
     perf_metrics : dict
                    Contains all calculated metrics
     '''
-    y_pred = threshold_argmax(y_score_1c, thresh=thresh)
-    tn, fp, fn, tp = confusion_matrix(y_true, y_pred, labels=labels).ravel()
+    metrics = BinaryMetrics(y_true, y_score_1c, thresh=thresh, labels=labels)
 
     # calculate all metrics
-    perf_metrics = dict()
-
-    perf_metrics["acc"] = (tn+tp) / (tn+tp+fn+fp)
-    perf_metrics["sens"] = tp / (tp+fn)
-    perf_metrics["spec"] = tn / (tn+fp)
-
-    if bal_acc:
-        perf_metrics["bal_acc"] = balanced_accuracy_score(y_true, y_pred)
-    if youden:
-        perf_metrics["youden"] = youdens_jstats(perf_metrics["sens"], perf_metrics["spec"])
-    if auroc:
-        if len(set(y_true.tolist())) > 1:
-            perf_metrics["auroc"] = roc_auc_score(y_true, y_score_1c)
-        else:
-            perf_metrics["auroc"] = np.nan
-    if err_rate:
-        perf_metrics["err_rate"] = 1 - perf_metrics["acc"]
-    if bal_err_rate:
-        perf_metrics["bal_err_rate"] = 1 - balanced_accuracy_score(y_true, y_pred)
+    optional = {"bal_acc": bal_acc, "youden": youden, "auroc": auroc, "err_rate": err_rate, "bal_err_rate": bal_err_rate}
+    perf_metrics = metrics.compute("acc", "sens", "spec", *[k for k, v in optional.items() if v])
 
     return perf_metrics
 
+# Cell
+def _confusion_metrics(tn, fp, fn, tp):
+    '''All metrics of ´BinaryMetrics´ (except AUROC) for arrays of confusion matrix entries'''
+    with np.errstate(divide="ignore", invalid="ignore"):
+        acc = (tn+tp) / (tn+tp+fn+fp)
+        sens, spec = tp / (tp+fn), tn / (tn+fp)
+        # same as sklearn's balanced accuracy, i.e. classes missing in y_true are ignored
+        n_recalls = (~np.isnan(sens)).astype(np.int64) + ~np.isnan(spec)
+        bal_acc = (np.nan_to_num(sens) + np.nan_to_num(spec)) / n_recalls
+    return {"acc": acc, "sens": sens, "spec": spec, "bal_acc": bal_acc, "youden": youdens_jstats(sens, spec),
+            "err_rate": 1 - acc, "bal_err_rate": 1 - bal_acc}
+
+def performance_curve(y_true, y_score_1c, threshs=None, labels:list=[0, 1]):
+    '''Compute threshold dependent performance metrics for many tresholds at once
+
+    Scores of both classes are sorted once, afterwards the confusion matrix for every
+    treshold is obtained with a binary search. As in ´performance´, a score is assigned
+    to the positive class if it is larger than the treshold. Metrics are the same as of
+    ´BinaryMetrics´, e.g. a class missing in ´y_true´ is ignored by the balanced accuracy.
+
+    Parameters
+    ----------
+    y_true : 1d array-like
+             Ground truth (correct) target values
+
+    y_score_1c : 1d array-like of floats
+                 Target scores of the positive class (see ´performance´)
+
+    threshs : 1d array-like of floats; optional
+              Tresholds at which metrics are evaluated. If None, all unique scores are used.
+
+    labels : list, default=[0, 1]
+             Negative and positive label in ´y_true´ (items with other labels are ignored, as in ´performance´)
+
+    Returns
+    -------
+    perf_curve : pd.DataFrame
+                 One row per treshold with columns ´thresh´, ´tp´, ´fp´, ´tn´, ´fn´,
+                 ´acc´, ´sens´, ´spec´, ´bal_acc´, ´youden´, ´err_rate´ and ´bal_err_rate´
+    '''
+    y_true, y_score_1c = np.asarray(y_true).ravel(), np.asarray(y_score_1c, dtype=np.float64).ravel()
+    threshs = np.unique(y_score_1c) if threshs is None else np.asarray(threshs, dtype=np.float64).ravel()
+
+    pos_scores = np.sort(y_score_1c[y_true == labels[1]])
+    neg_scores = np.sort(y_score_1c[y_true == labels[0]])
+    n_pos, n_neg = len(pos_scores), len(neg_scores)
+
+    # number of scores per class that are smaller or equal to the treshold
+    fn = np.searchsorted(pos_scores, threshs, side="right")
+    tn = np.searchsorted(neg_scores, threshs, side="right")
+    tp, fp = n_pos - fn, n_neg - tn
+
+    return pd.DataFrame({"thresh": threshs, "tp": tp, "fp": fp, "tn": tn, "fn": fn, **_confusion_metrics(tn, fp, fn, tp)})
+
+def best_threshold(y_true, y_score_1c, metric:str="youden", threshs=None, labels:list=[0, 1]):
+    '''Find the treshold which maximizes ´metric´ (any column of ´performance_curve´)
+
+    Raises a ValueError if ´metric´ is NaN at every treshold (e.g. ´youden´ if ´y_true´ only contains one class).
+
+    Returns
+    -------
+    thresh, value : tuple of floats
+                    Optimal treshold and the metric's value at that treshold
+    '''
+    perf_curve = performance_curve(y_true, y_score_1c, threshs=threshs, labels=labels)
+    values = perf_curve[metric].to_numpy()
+    if np.isnan(values).all():
+        raise ValueError(f"´{metric}´ is undefined at every treshold, e.g. because ´y_true´ only contains one class")
+    if metric in ["err_rate", "bal_err_rate"]:
+        idx = np.nanargmin(values)
+    else:
+        idx = np.nanargmax(values)
+    return perf_curve["thresh"].iloc[idx], values[idx]
+
+# Cell
+def _resample_idxs(rng, n_resamples, strata):
+    '''Index matrix of shape (n_resamples, number of samples), every stratum is resampled with its own size'''
+    return np.concatenate([stratum[rng.integers(0, len(stratum), (n_resamples, len(stratum)))] for stratum in strata], axis=1)
+
+def _resampled_auroc(codes, is_pos, is_neg, n_codes):
+    '''Rank-based AUROC of every row of resampled (tie-aware) score codes'''
+    n_resamples = len(codes)
+    codes = codes + (np.arange(n_resamples) * n_codes)[:, None]
+    pos_counts = np.bincount(codes[is_pos], minlength=n_resamples*n_codes).reshape(n_resamples, n_codes)
+    neg_counts = np.bincount(codes[is_neg], minlength=n_resamples*n_codes).reshape(n_resamples, n_codes)
+    # every positive beats all negatives with a smaller score and ties count half
+    neg_below = np.cumsum(neg_counts, axis=1) - neg_counts
+    wins = (pos_counts * (neg_below + 0.5*neg_counts)).sum(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return wins / (pos_counts.sum(axis=1) * neg_counts.sum(axis=1).astype(np.float64))
+
+def _bootstrap_batch(seed, n_resamples, strata, is_pos, is_neg, y_pred, codes, n_codes, metrics):
+    '''Metrics (array of shape (n_resamples, number of metrics)) of a batch of bootstrap resamples'''
+    idxs = _resample_idxs(np.random.default_rng(seed), n_resamples, strata)
+    pos, neg, pred = is_pos[idxs], is_neg[idxs], y_pred[idxs]
+    values = _confusion_metrics(tn=np.count_nonzero(neg & ~pred, axis=1), fp=np.count_nonzero(neg & pred, axis=1),
+                                fn=np.count_nonzero(pos & ~pred, axis=1), tp=np.count_nonzero(pos & pred, axis=1))
+    if "auroc" in metrics:
+        values["auroc"] = _resampled_auroc(codes[idxs], pos, neg, n_codes)
+    return np.stack([values[metric] for metric in metrics], axis=1)
+
+def bootstrap_ci(y_true, y_score_1c, metrics:list=None, thresh:float=0.5, labels:list=[0, 1], n_resamples:int=1000,
+                 alpha:float=0.05, stratified:bool=False, random_state=None, batch_size:int=None, num_workers:int=0):
+    '''Bootstrap percentile confidence intervals of binary classification metrics
+
+    Resample index matrices are drawn for a whole batch of resamples at once and all metrics are evaluated
+    batched: confusion matrices by counting along the resample axis and AUROC rank-based on score histograms
+    (ties count half as in ´roc_auc_score´). For a given ´random_state´ and ´batch_size´ the results
+    do not depend on ´num_workers´.
+
+    Parameters
+    ----------
+    y_true : 1d array-like
+             Ground truth (correct) target values
+
+    y_score_1c : 1d array-like of floats
+                 Target scores of the positive class (see ´performance´)
+
+    metrics : list; optional
+              Any of ´BinaryMetrics.metric_names´ (all if None)
+
+    thresh : float, default=0.5
+             Treshold
+
+    labels : list, default=[0, 1]
+             Negative and positive label in ´y_true´
+
+    n_resamples : int, default=1000
+                  Number of bootstrap resamples
+
+    alpha : float, default=0.05
+            Intervals cover the central 1-´alpha´ of the bootstrap distribution
+
+    stratified : bool, default=False
+                 Whether positives and negatives are resampled separately (keeping the class sizes fixed)
+
+    random_state : int; optional
+                   Seed of the resampling
+
+    batch_size : int; optional
+                 Number of resamples that are evaluated at once (chosen by the number of samples if None)
+
+    num_workers : int, default=0
+                  Number of processes that evaluate batches in parallel (main process only if 0)
+
+    Returns
+    -------
+    ci : pd.DataFrame
+         One row per metric with the point estimate (´estimate´) and the interval bounds (´lower´, ´upper´)
+    '''
+    metrics = BinaryMetrics.metric_names if metrics is None else list(metrics)
+    unknown = set(metrics) - set(BinaryMetrics.metric_names)
+    if len(unknown) > 0:
+        raise ValueError(f"Unknown metrics {sorted(unknown)}")
+
+    point = BinaryMetrics(y_true, y_score_1c, thresh=thresh, labels=labels)
+    is_pos, is_neg = point.y_true == labels[1], point.y_true == labels[0]
+    y_pred = threshold_argmax(point.y_score_1c, thresh=thresh).astype(bool)
+    codes = np.unique(point.y_score_1c, return_inverse=True)[1].ravel()
+    n_codes = codes.max() + 1 if len(codes) > 0 else 0
+    strata = [np.flatnonzero(is_pos), np.flatnonzero(~is_pos)] if stratified else [np.arange(len(codes))]
+    strata = [stratum for stratum in strata if len(stratum) > 0]
+
+    # bounded memory per batch (index matrix and score histograms)
+    if batch_size is None:
+        batch_size = max(1, 2**22 // max(len(codes), n_codes, 1))
+    batch_sizes = [min(batch_size, n_resamples - start) for start in range(0, n_resamples, batch_size)]
+    seeds = np.random.SeedSequence(random_state).spawn(len(batch_sizes))
+    args = (strata, is_pos, is_neg, y_pred, codes, n_codes, metrics)
+
+    if num_workers > 0:
+        with ProcessPoolExecutor(max_workers=num_workers) as pool:
+            futures = [pool.submit(_bootstrap_batch, seed, size, *args) for seed, size in zip(seeds, batch_sizes)]
+            values = [future.result() for future in futures]
+    else:
+        values = [_bootstrap_batch(seed, size, *args) for seed, size in zip(seeds, batch_sizes)]
+    values = np.concatenate(values, axis=0)
+
+    with np.errstate(invalid="ignore"):
+        lower, upper = np.nanpercentile(values, [100*alpha/2, 100*(1 - alpha/2)], axis=0)
+    return pd.DataFrame({"estimate": [point[metric] for metric in metrics], "lower": lower, "upper": upper}, index=metrics)
+
 # Cell
 def auroc(preds, **kwargs):
     '''AUROC rate for fastai-style-like prediction i.e. tuple of two tensors like (probs, gt)'''
-    perf = performance(preds[1], preds[0][:,1], auroc=True, **kwargs)
-    return perf["auroc"]
+    return BinaryMetrics.from_preds(preds, **kwargs)["auroc"]
 
 def specificity(preds, **kwargs):
     '''Specificity for fastai-style-like prediction i.e. tuple of two tensors like (probs, gt)'''
-    perf = performance(preds[1], preds[0][:,1], **kwargs)
-    return perf["sens"]
+    return BinaryMetrics.from_preds(preds, **kwargs)["sens"]
 
 def sensitivity(preds, **kwargs):
     '''Sensitivity for fastai-style-like prediction i.e. tuple of two tensors like (probs, gt)'''
-    perf = performance(preds[1], preds[0][:,1], **kwargs)
-    return perf["spec"]
+    return BinaryMetrics.from_preds(preds, **kwargs)["spec"]
 
 def accuracy(preds, **kwargs):
     '''Accuracy for fastai-style-like prediction i.e. tuple of two tensors like (probs, gt)'''
-    perf = performance(preds[1], preds[0][:,1], **kwargs)
-    return perf["acc"]
+    return BinaryMetrics.from_preds(preds, **kwargs)["acc"]
 
 def bal_accuracy(preds, **kwargs):
     '''Balanced accuracy for  fastai-style-like prediction i.e. tuple of two tensors like (probs, gt)'''
-    perf = performance(preds[1], preds[0][:,1], bal_acc=True, **kwargs)
-    return perf["bal_acc"]
+    return BinaryMetrics.from_preds(preds, **kwargs)["bal_acc"]
 
 def error_rate(preds, **kwargs):
     '''Error rate for fastai-style-like prediction i.e. tuple of two tensors like (probs, gt)'''
-    perf = performance(preds[1], preds[0][:,1], err_rate=True, **kwargs)
-    return perf["err_rate"]
+    return BinaryMetrics.from_preds(preds, **kwargs)["err_rate"]
 
 def bal_error_rate(preds, **kwargs):
     '''Balanced error rate for fastai-style-like prediction i.e. tuple of two tensors like (probs, gt)'''
-    perf = performance(preds[1], preds[0][:,1], bal_err_rate=True, **kwargs)
-    return perf["bal_err_rate"]
\ No newline at end of file
+    return BinaryMetrics.from_preds(preds, **kwargs)["bal_err_rate"]
\ No newline at end of file
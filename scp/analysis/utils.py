@@ -1,11 +1,12 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: nb_analysis.utils.ipynb (unless otherwise specified).
 
-__all__ = ['concat_preds', 'ensemble', 'verify_softmax']
+__all__ = ['concat_preds', 'ensemble', 'verify_softmax', 'ensemble_methods']
 
 # Cell
 import pandas as pd
 import numpy as np
 import torch
+import os
 
 # Cell
 def concat_preds(preds_list:list) -> tuple:
@@ -21,34 +22,109 @@ def concat_preds(preds_list:list) -> tuple:
     -------
     Fastai-style-like prediction
     '''
-    probs = torch.cat(tuple([v[0] for v in preds_list]))
-    gt = torch.cat(tuple([v[1] for v in preds_list]))
+    probs = torch.cat([v[0] for v in preds_list])
+    gt = torch.cat([v[1] for v in preds_list])
 
     return (probs, gt)
 
-def ensemble(preds_list:list) -> tuple:
+def _load_preds(preds, key=None):
+    '''Load a fastai-style-like prediction saved with ´torch.save´ (optionally stored under ´key´ of a dict)'''
+    if isinstance(preds, (str, os.PathLike)):
+        preds = torch.load(preds, map_location="cpu")
+    if key is not None:
+        preds = preds[key]
+    return preds
+
+def _rank(probs:torch.Tensor) -> torch.Tensor:
+    '''Rank of every element within its column (ties get their average rank) scaled to [0, 1]'''
+    ranks = torch.empty(probs.shape, dtype=torch.float64)
+    for c in range(probs.shape[1]):
+        values, order = probs[:, c].sort()
+        _, inverse, counts = torch.unique_consecutive(values, return_inverse=True, return_counts=True)
+        mean_ranks = counts.cumsum(0) - 1 - (counts - 1) / 2
+        ranks[order, c] = mean_ranks.double()[inverse]
+    return ranks / max(len(probs) - 1, 1)
+
+ensemble_methods = ["mean", "weighted", "geometric", "median", "rank"]
+
+def ensemble(preds_list:list, method:str="mean", weights=None, key=None, eps:float=1e-7) -> tuple:
     '''Ensemble a list of fastai-style-like predictions into a single fastai-style-like prediction.
 
-    Simple ensemble using averaging.
+    Predictions are accumulated into a single preallocated buffer. If ´preds_list´ contains file paths,
+    predictions are loaded one after another, hence only one model's predictions reside in memory at once
+    (except for ´method="median"´, which needs all of them in one stacked buffer). Sums are accumulated in
+    float64 and cast back to the dtype of the predictions, hence half precision predictions of many models
+    do not lose precision.
 
     Parameters
     ----------
     preds_list : list
         List of tuples where each tuple contains two tensors.
         First tensor contains probabilities and second one ground truth.
+        Instead of tuples, paths to files saved with ´torch.save´ can be passed.
+
+    method : str; optional
+        One of ´ensemble_methods´:
+        ´mean´ (average of probabilities), ´weighted´ (weighted average with ´weights´),
+        ´geometric´ (normalized geometric mean), ´median´ (element-wise median) or
+        ´rank´ (average of per-class ranks scaled to [0, 1], these are scores and not probabilities).
+
+    weights : list; optional
+        Weight of every model (only used with ´method="weighted"´)
+
+    key : str; optional
+        If the loaded predictions are dicts of predictions (e.g. saved by ´PredictionWriter´), the key to use
+
+    eps : float; optional
+        Probabilities are clipped to ´eps´ before taking the logarithm (´method="geometric"´)
 
     Returns
     -------
     Fastai-style-like prediction
     '''
+    if method not in ensemble_methods:
+        raise ValueError(f"Unknown ensemble method ´{method}´, choose one of {ensemble_methods}")
     n = len(preds_list)
+    if method == "weighted":
+        if weights is None or len(weights) != n:
+            raise ValueError("´weights´ are required for every prediction with method ´weighted´")
+        weights = np.asarray(weights, dtype=np.float64) / np.sum(weights)
+
+    for idx, preds in enumerate(preds_list):
+        probs, gt_ = _load_preds(preds, key)
+        if idx == 0:
+            gt = gt_.clone()
+            dtype = probs.dtype
+            buffer = torch.empty((n,) + probs.shape if method == "median" else probs.shape,
+                                 dtype=dtype if method == "median" else torch.float64)
+            if method != "median":
+                buffer.zero_()
+        else:
+            assert torch.equal(gt, gt_), "Ground truth tensors do not match. Unequal size or elements."
 
-    probs, gt = preds_list[0][0].clone(), preds_list[0][1].clone()
-    for preds in preds_list[1:]:
-        assert torch.equal(gt, preds[1]), "Ground truth tensors do not match. Unequal size or elements."
-        probs += preds[0]
+        if method == "mean":
+            buffer.add_(probs)
+        elif method == "weighted":
+            buffer.add_(probs, alpha=weights[idx])
+        elif method == "geometric":
+            buffer.add_(probs.double().clamp_min(eps).log_())
+        elif method == "median":
+            buffer[idx] = probs
+        elif method == "rank":
+            buffer.add_(_rank(probs))
+        del probs
 
-    return (probs/n, gt)
+    if method == "median":
+        buffer = buffer.sort(dim=0).values
+        return (((buffer[(n - 1) // 2].double() + buffer[n // 2]) / 2).to(dtype), gt)
+    if method == "rank":
+        return (buffer.div_(n), gt) # scores keep float64
+    if method != "weighted":
+        buffer.div_(n)
+    if method == "geometric":
+        buffer.exp_()
+        buffer.div_(buffer.sum(dim=1, keepdim=True))
+    return (buffer.to(dtype), gt)
 
 def verify_softmax(preds:tuple):
     '''Verify softmax for a single fastai-style-like prediction.
@@ -3,11 +3,29 @@
 __all__ = ['MultiLabelDataFrameDataModule', 'DataFrameDataModule']
 
 # Cell
-from torch.utils.data import DataLoader
-from torchsampler import ImbalancedDatasetSampler
+from torch.utils.data import DataLoader, IterableDataset
+from torch.utils.data.dataloader import default_collate
+from functools import partial
 from pytorch_lightning import LightningDataModule
 from .dataset import DataFrameImageDataset, MultiLabelDataFrameImageDataset
+from .sampler import BalancedSampler
+from .shards import ShardedImageDataset, ShardedIterableImageDataset, EpochDataLoader
 import pandas as pd
+import numpy as np
+
+def _batch_tfm_collate(batch_tfm, items):
+    '''Collate function that applies ´batch_tfm´ to the collated images (first element of every item)'''
+    batch = default_collate(items)
+    return [batch_tfm(batch[0])] + list(batch[1:])
+
+def _subset_idxs(set_values):
+    '''Row positions of every unique value of the set column (missing values are skipped)'''
+    codes, subset_names = pd.factorize(set_values, sort=True) # fastest for categorical set columns
+    if len(subset_names) < np.iinfo(np.int16).max:
+        codes = codes.astype(np.int16) # numpy uses radix sort for small integers
+    counts = np.bincount(codes[codes >= 0], minlength=len(subset_names))
+    order = np.argsort(codes, kind="stable")[(codes < 0).sum():]
+    return dict(zip(subset_names, np.split(order, np.cumsum(counts)[:-1])))
 
 class MultiLabelDataFrameDataModule(LightningDataModule):
     '''Data module where the underlying dataset is a ´DataFrameImageDataset´.
@@ -47,7 +65,54 @@ class MultiLabelDataFrameDataModule(LightningDataModule):
         Number of cpu cores.
 
     balance_train_ds : bool, optional
-        If True, the train dataloader samples balanced batches.
+        If True, the train dataloader samples balanced epochs (see ´BalancedSampler´).
+
+    balance_strategy : str, optional
+        Strategy used to balance the train dataset (´downsample´, ´upsample´ or ´balance´).
+
+    balance_size : int, optional
+        Class size used to balance the train dataset (see ´BalancedSampler´).
+
+    cache_dir : str; optional
+        If set, decoded images of all datasets are cached in this directory (see ´ImageCache´).
+
+    cache_img_size : int or tuple; optional
+        If set, images are resized to this size before they are cached.
+
+    cache_num_threads : int; optional
+        Number of threads that decode images when the cache is built.
+
+    load_size : int or tuple; optional
+        If set, JPEGs are decoded at a reduced resolution that is still at least this size (see ´read_img´).
+
+    decoder : str or callable; optional
+        Decoder used to read images (see ´read_img´).
+
+    pin_memory : bool; optional
+        If True, batches are copied to page-locked memory (faster host to GPU transfer).
+
+    persistent_workers : bool; optional
+        If True, worker processes are kept alive between epochs instead of being respawned
+        for every pass over a dataloader (saves the worker startup of every epoch, but the
+        workers and their memory stay allocated). Only used if ´num_workers > 0´.
+
+    prefetch_factor : int; optional
+        Number of batches loaded in advance by each worker. If None, the PyTorch default is used.
+        Only used if ´num_workers > 0´.
+
+    batch_tfms : dict; optional
+        Dict of transforms of whole image batches (e.g. the ´BatchTransforms´ of ´get_train_tfms(..., batched=True)´),
+        with the same keys as ´transforms´. They are applied to the collated images by the collate function,
+        i.e. in the dataloader workers. To run them on the GPU instead, leave them out here and apply them to
+        the batch on the device (e.g. in ´on_after_batch_transfer´ of the model).
+
+    Dataloaders are created once per set and reused on subsequent ´*_dataloader()´ calls.
+    They are rebuilt after ´setup()´ or ´update_ds_tfms()´ for the affected set.
+
+    ´setup()´ only parses the set column (once) into the row positions of every subset.
+    Datasets are created lazily when a set is accessed for the first time. Every dataset gets
+    ´df.iloc[rows, needed columns]´, i.e. a temporary copy of only its rows and of the image and
+    label columns, which is released once the dataset has encoded it into its own arrays.
     '''
     def __init__(
         self,
@@ -60,7 +125,18 @@ class MultiLabelDataFrameDataModule(LightningDataModule):
         label_class_names=None,
         batch_size=32,
         num_workers=1,
-        balance_train_ds=False
+        balance_train_ds=False,
+        balance_strategy="balance",
+        balance_size=None,
+        cache_dir=None,
+        cache_img_size=None,
+        cache_num_threads=8,
+        load_size=None,
+        decoder="opencv",
+        pin_memory=False,
+        persistent_workers=False,
+        prefetch_factor=None,
+        batch_tfms=dict()
     ):
         super().__init__()
         self.df = df
@@ -73,7 +149,19 @@ class MultiLabelDataFrameDataModule(LightningDataModule):
         self.batch_size = batch_size
         self.num_workers = num_workers
         self.balance_train_ds = balance_train_ds
-
+        self.balance_strategy = balance_strategy
+        self.balance_size = balance_size
+        self.cache_dir = cache_dir
+        self.cache_img_size = cache_img_size
+        self.cache_num_threads = cache_num_threads
+        self.load_size = load_size
+        self.decoder = decoder
+        self.pin_memory = pin_memory
+        self.persistent_workers = persistent_workers
+        self.prefetch_factor = prefetch_factor
+        self.batch_tfms = batch_tfms
+
+        self._dls = dict()
         self.setup_called = False
 
     def setup(self, stage=None, ):
@@ -82,37 +170,52 @@ class MultiLabelDataFrameDataModule(LightningDataModule):
             print("Setup has already been called. Set attribute 'setup_called=False' if you want to explicitly reset this.")
         else:
             self.setup_called = True
-            self._train_dss, self.train_dss_names = self._get_datasets(set_name="train")
-            self._val_dss, self.val_dss_names = self._get_datasets(set_name="val")
-            self._test_dss, self.test_dss_names = self._get_datasets(set_name="test")
-            self._predict_dss, self.predict_dss_names = self._get_datasets(set_name="predict")
+            self._dls = dict()
+            self._dss = dict()
+            self._subset_idxs = _subset_idxs(self.df[self.set_col])
+
+    def _get_set_dss(self, set_name):
+        '''Dataset(s) of a set, created on first access'''
+        if set_name not in self._dss:
+            self._dss[set_name], _ = self._get_datasets(set_name)
+        return self._dss[set_name]
+
+    _train_dss = property(lambda self: self._get_set_dss("train"))
+    _val_dss = property(lambda self: self._get_set_dss("val"))
+    _test_dss = property(lambda self: self._get_set_dss("test"))
+    _predict_dss = property(lambda self: self._get_set_dss("predict"))
+    train_dss_names = property(lambda self: list(self._get_set_idxs("train")))
+    val_dss_names = property(lambda self: list(self._get_set_idxs("val")))
+    test_dss_names = property(lambda self: list(self._get_set_idxs("test")))
+    predict_dss_names = property(lambda self: list(self._get_set_idxs("predict")))
 
     def train_dataloader(self, idx=0):
         sampler, shuffle = None, True
         if self.balance_train_ds:
-            sampler, shuffle = ImbalancedDatasetSampler, False
-        dls = self._get_dataloaders(self._train_dss, sampler, shuffle)
+            sampler = partial(BalancedSampler.from_dataset, strategy=self.balance_strategy, size=self.balance_size)
+            shuffle = False
+        dls = self._get_dataloaders("train", self._train_dss, sampler, shuffle)
         if idx != None:
             return dls[idx]
         return dls
 
     def val_dataloader(self, idx=None):
         sampler, shuffle = None, False
-        dls = self._get_dataloaders(self._val_dss, sampler, shuffle)
+        dls = self._get_dataloaders("val", self._val_dss, sampler, shuffle)
         if idx != None:
             return dls[idx]
         return dls
 
     def test_dataloader(self, idx=None):
         sampler, shuffle = None, False
-        dls = self._get_dataloaders(self._test_dss, sampler, shuffle)
+        dls = self._get_dataloaders("test", self._test_dss, sampler, shuffle)
         if idx != None:
             return dls[idx]
         return dls
 
     def predict_dataloader(self, idx=None):
         sampler, shuffle = None, False
-        dls = self._get_dataloaders(self._predict_dss, sampler, shuffle)
+        dls = self._get_dataloaders("predict", self._predict_dss, sampler, shuffle)
         if idx != None:
             return dls[idx]
         return dls
@@ -137,7 +240,23 @@ class MultiLabelDataFrameDataModule(LightningDataModule):
             return self._predict_dss[idx]
         return self._predict_dss
 
-    def _get_dataloaders(self, dss, sampler, shuffle):
+    def _collate_fn(self, set_name):
+        '''Collate function which applies the batch transforms of a set (None for the default collate function)'''
+        if self.batch_tfms.get(set_name) is None:
+            return None
+        return partial(_batch_tfm_collate, self.batch_tfms[set_name])
+
+    def _get_dataloaders(self, set_name, dss, sampler, shuffle):
+        # reuse loaders (and with them persistent workers) of previous calls
+        if set_name in self._dls:
+            return self._dls[set_name]
+
+        worker_kwargs = dict()
+        if self.num_workers > 0:
+            worker_kwargs["persistent_workers"] = self.persistent_workers
+            if self.prefetch_factor is not None:
+                worker_kwargs["prefetch_factor"] = self.prefetch_factor
+
         dls = list()
         for ds in dss:
 
@@ -150,9 +269,13 @@ class MultiLabelDataFrameDataModule(LightningDataModule):
                 batch_size=self.batch_size,
                 num_workers=self.num_workers,
                 sampler=sampler_instance,
-                shuffle=shuffle
+                shuffle=shuffle,
+                collate_fn=self._collate_fn(set_name),
+                pin_memory=self.pin_memory,
+                **worker_kwargs
             ))
 
+        self._dls[set_name] = dls
         return dls
 
     def _get_datasets(self, set_name):
@@ -167,36 +290,45 @@ class MultiLabelDataFrameDataModule(LightningDataModule):
         -------
         List with at least one ´DataFrameImageDataset´ (which could be empty)
         '''
+        set_idxs = self._get_set_idxs(set_name)
 
-        set_df = self.df[self.df[self.set_col].str.contains(set_name)]
-
-        # get subset dataframe(s) for this particular set
-        subset_names = list()
-        subset_dfs = list()
-        for subset_name, subset_df in set_df.groupby(self.set_col, sort=True):
-            subset_names.append(subset_name)
-            subset_dfs.append(subset_df.reset_index(drop=True))
-
-        # in case no subsets where found, add empty df for compatibility
-        if len(subset_dfs)==0:
-            subset_names.append(set_name)
-            subset_dfs.append(pd.DataFrame(columns=set_df.columns))
+        # iloc copies, hence only the rows and columns used by a dataset are copied and only one subset at a time
+        label_cols = self.label_cols if isinstance(self.label_cols, list) else [self.label_cols,]
+        col_names = [self.img_col] + [col for col in label_cols if col is not None]
+        cols = self.df.columns.get_indexer(col_names)
+        if (cols < 0).any():
+            raise KeyError(f"Columns {[col for col, i in zip(col_names, cols) if i < 0]} not in the dataframe")
 
         # create dataset(s) for this particular set
         subset_dss = list()
-        for subset_df in subset_dfs:
+        for idxs in set_idxs.values():
             subset_dss.append(MultiLabelDataFrameImageDataset(
-                df=subset_df,
+                df=self.df.iloc[idxs, cols],
                 img_col=self.img_col,
                 label_cols=self.label_cols,
                 root=self.root,
                 img_transform=self.transforms.get(set_name),
                 label_class_names=self.label_class_names,
+                cache_dir=self.cache_dir,
+                cache_img_size=self.cache_img_size,
+                cache_num_threads=self.cache_num_threads,
+                load_size=self.load_size,
+                decoder=self.decoder,
             ))
 
-        return subset_dss, subset_names
+        return subset_dss, list(set_idxs)
+
+    def _get_set_idxs(self, set_name):
+        '''Row positions of every subset of a set (i.e. set column values that contain ´set_name´)'''
+        set_idxs = {name: idxs for name, idxs in self._subset_idxs.items() if set_name in name}
+        # in case no subsets where found, add empty subset for compatibility
+        if len(set_idxs)==0:
+            set_idxs[set_name] = np.zeros(0, dtype=np.int64)
+        return set_idxs
 
     def update_ds_tfms(self, set_name, idx, tfms):
+        # workers hold copies of the datasets, hence loaders have to be rebuilt
+        self._dls.pop(set_name, None)
         if set_name=="train":
             self._train_dss[idx].img_transform = tfms
         elif set_name=="val":
@@ -246,7 +378,58 @@ class DataFrameDataModule(LightningDataModule):
         Number of cpu cores.
 
     balance_train_ds : bool, optional
-        If True, the train dataloader samples balanced batches.
+        If True, the train dataloader samples balanced epochs (see ´BalancedSampler´).
+
+    balance_strategy : str, optional
+        Strategy used to balance the train dataset (´downsample´, ´upsample´ or ´balance´).
+
+    balance_size : int, optional
+        Class size used to balance the train dataset (see ´BalancedSampler´).
+
+    cache_dir : str; optional
+        If set, decoded images of all datasets are cached in this directory (see ´ImageCache´).
+
+    cache_img_size : int or tuple; optional
+        If set, images are resized to this size before they are cached.
+
+    cache_num_threads : int; optional
+        Number of threads that decode images when the cache is built.
+
+    load_size : int or tuple; optional
+        If set, JPEGs are decoded at a reduced resolution that is still at least this size (see ´read_img´).
+
+    decoder : str or callable; optional
+        Decoder used to read images (see ´read_img´).
+
+    pin_memory : bool; optional
+        If True, batches are copied to page-locked memory (faster host to GPU transfer).
+
+    persistent_workers : bool; optional
+        If True, worker processes are kept alive between epochs instead of being respawned
+        for every pass over a dataloader (saves the worker startup of every epoch, but the
+        workers and their memory stay allocated). Only used if ´num_workers > 0´.
+
+    prefetch_factor : int; optional
+        Number of batches loaded in advance by each worker. If None, the PyTorch default is used.
+        Only used if ´num_workers > 0´.
+
+    batch_tfms : dict; optional
+        Dict of transforms of whole image batches (e.g. the ´BatchTransforms´ of ´get_train_tfms(..., batched=True)´),
+        with the same keys as ´transforms´. They are applied to the collated images by the collate function,
+        i.e. in the dataloader workers. To run them on the GPU instead, leave them out here and apply them to
+        the batch on the device (e.g. in ´on_after_batch_transfer´ of the model).
+
+    shard_dir : str; optional
+        If set, images are read from the shards in this directory (see ´write_shards´) and ´df´
+        must be the shard index (see ´read_shard_index´). ´root´, ´cache_dir´ and ´cache_img_size´ are ignored.
+
+    iterable_train_ds : bool; optional
+        If True, the train dataset reads whole shards sequentially with shard-level shuffling
+        (see ´ShardedIterableImageDataset´) instead of random access to single images.
+        Requires ´shard_dir´ and cannot be combined with ´balance_train_ds´.
+
+    Dataloaders are created once per set and reused on subsequent ´*_dataloader()´ calls.
+    They are rebuilt after ´setup()´ or ´update_ds_tfms()´ for the affected set.
     '''
     def __init__(
         self,
@@ -259,9 +442,24 @@ class DataFrameDataModule(LightningDataModule):
         label_names=None,
         batch_size=16,
         num_workers=1,
-        balance_train_ds=False
+        balance_train_ds=False,
+        balance_strategy="balance",
+        balance_size=None,
+        cache_dir=None,
+        cache_img_size=None,
+        cache_num_threads=8,
+        load_size=None,
+        decoder="opencv",
+        pin_memory=False,
+        persistent_workers=False,
+        prefetch_factor=None,
+        shard_dir=None,
+        iterable_train_ds=False,
+        batch_tfms=dict()
     ):
         super().__init__()
+        if iterable_train_ds and (shard_dir is None or balance_train_ds):
+            raise ValueError("´iterable_train_ds´ requires ´shard_dir´ and cannot be combined with ´balance_train_ds´")
         self.df = df
         self.img_col = img_col
         self.set_col = set_col
@@ -272,9 +470,25 @@ class DataFrameDataModule(LightningDataModule):
         self.batch_size = batch_size
         self.num_workers = num_workers
         self.balance_train_ds = balance_train_ds
+        self.balance_strategy = balance_strategy
+        self.balance_size = balance_size
+        self.cache_dir = cache_dir
+        self.cache_img_size = cache_img_size
+        self.cache_num_threads = cache_num_threads
+        self.load_size = load_size
+        self.decoder = decoder
+        self.pin_memory = pin_memory
+        self.persistent_workers = persistent_workers
+        self.prefetch_factor = prefetch_factor
+        self.shard_dir = shard_dir
+        self.iterable_train_ds = iterable_train_ds
+        self.batch_tfms = batch_tfms
+
+        self._dls = dict()
         #self.setup()
 
     def setup(self, stage=None):
+        self._dls = dict()
         self.train_dss = self._get_datasets(set_name="train")
         self.val_dss = self._get_datasets(set_name="val")
         self.test_dss = self._get_datasets(set_name="test")
@@ -283,22 +497,39 @@ class DataFrameDataModule(LightningDataModule):
     def train_dataloader(self):
         sampler, shuffle = None, True
         if self.balance_train_ds:
-            sampler, shuffle = ImbalancedDatasetSampler, False
-        return self._get_dataloaders(self.train_dss, sampler, shuffle)[0] # DO not want to implement multiple dl trainging
+            sampler = partial(BalancedSampler.from_dataset, strategy=self.balance_strategy, size=self.balance_size)
+            shuffle = False
+        return self._get_dataloaders("train", self.train_dss, sampler, shuffle)[0] # DO not want to implement multiple dl trainging
 
     def val_dataloader(self):
         sampler, shuffle = None, False
-        return self._get_dataloaders(self.val_dss, sampler, shuffle)
+        return self._get_dataloaders("val", self.val_dss, sampler, shuffle)
 
     def test_dataloader(self):
         sampler, shuffle = None, False
-        return self._get_dataloaders(self.test_dss, sampler, shuffle)[0]
+        return self._get_dataloaders("test", self.test_dss, sampler, shuffle)[0]
 
     def predict_dataloader(self):
         sampler, shuffle = None, False
-        return self._get_dataloaders(self.predict_dss, sampler, shuffle)[0]
+        return self._get_dataloaders("predict", self.predict_dss, sampler, shuffle)[0]
+
+    def _collate_fn(self, set_name):
+        '''Collate function which applies the batch transforms of a set (None for the default collate function)'''
+        if self.batch_tfms.get(set_name) is None:
+            return None
+        return partial(_batch_tfm_collate, self.batch_tfms[set_name])
+
+    def _get_dataloaders(self, set_name, dss, sampler, shuffle):
+        # reuse loaders (and with them persistent workers) of previous calls
+        if set_name in self._dls:
+            return self._dls[set_name]
+
+        worker_kwargs = dict()
+        if self.num_workers > 0:
+            worker_kwargs["persistent_workers"] = self.persistent_workers
+            if self.prefetch_factor is not None:
+                worker_kwargs["prefetch_factor"] = self.prefetch_factor
 
-    def _get_dataloaders(self, dss, sampler, shuffle):
         dls = list()
         for ds in dss:
 
@@ -306,14 +537,25 @@ class DataFrameDataModule(LightningDataModule):
             if sampler:
                 sampler_instance = sampler(ds)
 
-            dls.append(DataLoader(
+            loader_cls, loader_kwargs = DataLoader, dict()
+            if isinstance(ds, ShardedIterableImageDataset):
+                # the epoch has to be advanced in the main process, workers only get a copy of the dataset
+                loader_cls = EpochDataLoader
+                loader_kwargs["epoch"] = self.trainer.current_epoch if self.trainer is not None else 0
+
+            dls.append(loader_cls(
                 dataset=ds,
                 batch_size=self.batch_size,
                 num_workers=self.num_workers,
                 sampler=sampler_instance,
-                shuffle=shuffle
+                shuffle=shuffle and not isinstance(ds, IterableDataset), # iterable datasets shuffle themselves
+                collate_fn=self._collate_fn(set_name),
+                pin_memory=self.pin_memory,
+                **worker_kwargs,
+                **loader_kwargs
             ))
 
+        self._dls[set_name] = dls
         return dls
 
     def _get_datasets(self, set_name):
@@ -343,6 +585,21 @@ class DataFrameDataModule(LightningDataModule):
         # create dataset(s) for this particular set
         subset_dss = list()
         for subset_df in subset_dfs:
+            if self.shard_dir is not None:
+                ds = ShardedImageDataset(
+                    df=subset_df,
+                    img_col=self.img_col,
+                    shard_dir=self.shard_dir,
+                    label_col=self.label_col,
+                    img_transform=self.transforms.get(set_name),
+                    label_names=self.label_names,
+                    load_size=self.load_size,
+                    decoder=self.decoder,
+                )
+                if self.iterable_train_ds and set_name == "train":
+                    ds = ShardedIterableImageDataset(ds)
+                subset_dss.append(ds)
+                continue
             subset_dss.append(DataFrameImageDataset(
                 df=subset_df,
                 img_col=self.img_col,
@@ -350,6 +607,11 @@ class DataFrameDataModule(LightningDataModule):
                 root=self.root,
                 img_transform=self.transforms.get(set_name),
                 label_names=self.label_names,
+                cache_dir=self.cache_dir,
+                cache_img_size=self.cache_img_size,
+                cache_num_threads=self.cache_num_threads,
+                load_size=self.load_size,
+                decoder=self.decoder,
             ))
 
         return subset_dss
\ No newline at end of file
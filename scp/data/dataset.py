@@ -1,6 +1,223 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: nb_data.dataset.ipynb (unless otherwise specified).
 
-__all__ = ['MultiLabelDataFrameImageDataset', 'DataFrameImageDataset']
+__all__ = ['ImageCache', 'MultiLabelDataFrameImageDataset', 'DataFrameImageDataset']
+
+# Cell
+import os
+import numpy as np
+import cv2
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from .decoder import read_img
+try:
+    import fcntl
+except ImportError: # no file locks on Windows
+    fcntl = None
+
+class ImageCache():
+    '''Sharded, memory-mapped cache of decoded images.
+
+    Images are decoded once (and optionally resized) and written as raw uint8 RGB pixels
+    into flat shard files. The shards are memory-mapped, hence all DataLoader workers share
+    the decoded pixels via the page cache instead of decoding every image in every epoch.
+    Cached images are returned as writable copies, i.e. transforms may modify them in-place.
+
+    Entries are keyed on the image path and its modification time. If an image changed
+    on disk after it was cached, it is re-decoded by ´build´. ´get´ only checks modification
+    times if ´check_mtime´ is set, since this costs one metadata lookup per image. Images that
+    do not exist are skipped by ´build´, i.e. they only fail when they are loaded.
+
+    Several processes (e.g. DDP ranks) can build the same cache concurrently: every build
+    writes its own shard files and the index is merged under a file lock.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Directory (ideally on local disk) in which shards and index are stored.
+        Images of different ´img_size´ are stored in separate subdirectories.
+
+    img_size : int or tuple; optional
+        If set, images are resized to ´img_size´ (int or (width, height)) before caching.
+
+    shard_size : int; optional
+        Maximum number of images per shard file.
+
+    decoder : str or callable; optional
+        Decoder used to read images from disk (see ´read_img´).
+
+    check_mtime : bool; optional
+        Whether ´get´ treats images that changed on disk after they were cached as misses.
+
+    Attributes
+    ----------
+    hits : int
+        Number of images served from the cache (counted per process).
+
+    misses : int
+        Number of images that had to be decoded (counted per process).
+    '''
+    def __init__(self, cache_dir, img_size=None, shard_size=4096, decoder="opencv", check_mtime=False):
+        if isinstance(img_size, int):
+            img_size = (img_size, img_size)
+        self.img_size = img_size
+        self.shard_size = shard_size
+        self.decoder = decoder
+        self.check_mtime = check_mtime
+        self.cache_dir = os.path.join(cache_dir, "native" if img_size is None else f"{img_size[0]}x{img_size[1]}")
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        self.hits = 0
+        self.misses = 0
+        self._shards = dict()
+        self._load_index()
+
+    def _load_index(self):
+        index_file = os.path.join(self.cache_dir, "index.npz")
+        if os.path.exists(index_file):
+            with np.load(index_file) as index:
+                self._paths = list(index["paths"])
+                self._mtimes, self._locs, self._shapes = index["mtimes"], index["locs"], index["shapes"]
+        else:
+            self._paths = list()
+            self._mtimes = np.zeros(0, dtype=np.int64)
+            self._locs = np.zeros((0, 2), dtype=np.int64) # (shard, offset)
+            self._shapes = np.zeros((0, 3), dtype=np.int64)
+        self._rows = {path: row for row, path in enumerate(self._paths)}
+
+    def _save_index(self):
+        index_file = os.path.join(self.cache_dir, "index.npz")
+        tmp_file = os.path.join(self.cache_dir, f"index.{os.getpid()}.tmp.npz")
+        np.savez(tmp_file, paths=np.array(self._paths, dtype=str), mtimes=self._mtimes, locs=self._locs, shapes=self._shapes)
+        os.replace(tmp_file, index_file)
+
+    @contextmanager
+    def _index_lock(self):
+        with open(os.path.join(self.cache_dir, "index.lock"), "w") as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _shard_file(self, shard):
+        return os.path.join(self.cache_dir, f"shard_{shard:05d}.bin")
+
+    def _new_shard(self, shard):
+        '''Atomically create the first free shard file from ´shard´ on (unique across processes)'''
+        while True:
+            try:
+                return shard, os.fdopen(os.open(self._shard_file(shard), os.O_CREAT | os.O_EXCL | os.O_WRONLY), "wb")
+            except FileExistsError:
+                shard += 1
+
+    def _lookup(self, path, check_mtime=True):
+        '''Row of an up-to-date cache entry for ´path´ or None'''
+        row = self._rows.get(path)
+        if row is None or (check_mtime and self._mtimes[row] != _mtime(path)):
+            return None
+        return row
+
+    def decode(self, path):
+        '''Read an image from disk as RGB numpy array (resized to ´img_size´ if set)'''
+        img = read_img(path, min_size=self.img_size, decoder=self.decoder)
+        if self.img_size is not None:
+            img = cv2.resize(img, self.img_size, interpolation=cv2.INTER_AREA)
+        return img
+
+    def build(self, paths, num_threads=8):
+        '''Decode and cache all images in ´paths´ that are not (or no longer) in the cache.
+
+        Returns the number of newly cached images. Images that do not exist are skipped.
+        '''
+        with self._index_lock():
+            self._load_index() # entries added by other processes
+        missing = list(dict.fromkeys(path for path in paths if self._lookup(path) is None and os.path.exists(path)))
+        if len(missing) == 0:
+            return 0
+
+        shard = 0
+        mtimes, locs, shapes = list(), list(), list()
+        with ThreadPoolExecutor(max_workers=num_threads) as pool:
+            for start in range(0, len(missing), self.shard_size):
+                chunk = missing[start:start+self.shard_size]
+                offset = 0
+                shard, f = self._new_shard(shard)
+                with f:
+                    for path, img in zip(chunk, pool.map(self.decode, chunk)):
+                        img = np.ascontiguousarray(img)
+                        f.write(img.tobytes())
+                        mtimes.append(os.stat(path).st_mtime_ns)
+                        locs.append((shard, offset))
+                        shapes.append(img.shape)
+                        offset += img.nbytes
+                shard += 1
+
+        # merge into the latest index, stale entries are re-pointed to their new location
+        # (the old pixels remain unreferenced)
+        with self._index_lock():
+            self._load_index()
+            self._add_entries(missing, mtimes, locs, shapes)
+            self._save_index()
+
+        return len(missing)
+
+    def _add_entries(self, missing, mtimes, locs, shapes):
+        for path in missing:
+            if path not in self._rows:
+                self._rows[path] = len(self._paths)
+                self._paths.append(path)
+        self._mtimes = np.resize(self._mtimes, len(self._paths))
+        self._locs = np.resize(self._locs, (len(self._paths), 2))
+        self._shapes = np.resize(self._shapes, (len(self._paths), 3))
+        rows = [self._rows[path] for path in missing]
+        self._mtimes[rows] = mtimes
+        self._locs[rows] = locs
+        self._shapes[rows] = shapes
+
+    def get(self, path):
+        '''Cached image for ´path´ (copied from the shard) or None if it is not cached'''
+        row = self._lookup(path, check_mtime=self.check_mtime)
+        if row is None:
+            return None
+        shard, offset = self._locs[row]
+        if shard not in self._shards:
+            self._shards[shard] = np.memmap(self._shard_file(shard), dtype=np.uint8, mode="r")
+        shape = tuple(self._shapes[row])
+        # copy, as views into the read-only memory map cannot be written (e.g. by in-place transforms or torch)
+        return np.array(self._shards[shard][offset:offset+int(np.prod(shape))].reshape(shape))
+
+    def load(self, path):
+        '''Get image from cache and fall back to decoding it on a miss'''
+        img = self.get(path)
+        if img is None:
+            self.misses += 1
+            return self.decode(path)
+        self.hits += 1
+        return img
+
+    def info(self):
+        return {"cached": len(self._paths), "hits": self.hits, "misses": self.misses}
+
+    def __len__(self):
+        return len(self._paths)
+
+    def __getstate__(self):
+        # memory maps are reopened lazily in every worker instead of being pickled as copies
+        state = self.__dict__.copy()
+        state["_shards"] = dict()
+        return state
+
+    def __repr__(self):
+        return f"ImageCache('{self.cache_dir}', cached={len(self)}, hits={self.hits}, misses={self.misses})"
+
+def _mtime(path):
+    '''Modification time of ´path´ in ns or None if it does not exist'''
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
 
 # Cell
 import os
@@ -11,8 +228,60 @@ import matplotlib.pyplot as plt
 import math
 import PIL
 import torch
+import pandas as pd
 from torch.utils.data import Dataset
-from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+def _encode_labels(labels, label_names, unknown_label=None):
+    '''Positions of ´labels´ in ´label_names´ as int64 array
+
+    Labels not in ´label_names´ raise a KeyError, unless they are encoded as ´unknown_label´ (e.g. -1).
+    '''
+    targets = pd.Index(label_names).get_indexer(labels).astype(np.int64)
+    unknown = targets == -1
+    if unknown.any():
+        if unknown_label is None:
+            unknown_labels = list(dict.fromkeys(np.asarray(labels, dtype=object)[unknown].tolist()))
+            raise KeyError(f"Labels {unknown_labels[:10]} are not in {list(label_names)}, set ´unknown_label´ to encode them")
+        targets[unknown] = unknown_label
+    return targets
+
+def _decode_labels(targets, label_names):
+    '''Inverse of ´_encode_labels´ (negative values, i.e. unknown labels, are decoded as None)'''
+    label_names = np.array(list(label_names) + [None], dtype=object)
+    return label_names[np.where(targets < 0, len(label_names) - 1, targets)].tolist()
+
+def _class_counts(targets, num_classes):
+    '''Number of images per class of encoded labels (labels encoded as -1 are not counted)'''
+    return np.bincount(targets[targets >= 0], minlength=num_classes)
+
+def _sample_img_sizes(ds, n, num_threads, random_state):
+    '''(width, height) of ´n´ random images (all if None) of ´ds´ read in parallel'''
+    idxs = np.arange(len(ds))
+    if n is not None and n < len(ds):
+        idxs = np.sort(np.random.default_rng(random_state).choice(len(ds), n, replace=False))
+    with ThreadPoolExecutor(max_workers=num_threads) as pool:
+        sizes = list(pool.map(ds.read_img_size, idxs))
+    return pd.DataFrame(np.array(sizes, dtype=np.int64).reshape(-1, 2), columns=["width", "height"], index=idxs)
+
+def _sample_idxs(targets, n, random=False, stratified=False):
+    '''Indices of ´n´ items (first or random ones).
+    If stratified, classes of ´targets´ are sampled in turns until ´n´ items are selected.'''
+    n = min(n, len(targets))
+    if not stratified:
+        return np.random.choice(len(targets), n, replace=False) if random else np.arange(n)
+    idxs = np.random.permutation(len(targets)) if random else np.arange(len(targets))
+    idxs = idxs[np.argsort(targets[idxs], kind="stable")]
+    classes = targets[idxs]
+    ranks = np.arange(len(idxs)) - np.searchsorted(classes, classes) # position of each item within its class
+    return idxs[np.lexsort((classes, ranks))[:n]]
+
+def _fetch_items(ds, idxs, num_threads):
+    '''´ds[idx]´ for all ´idxs´ fetched concurrently (decoding and most transforms release the GIL), in order'''
+    if num_threads <= 1 or len(idxs) <= 1:
+        return [ds[idx] for idx in idxs]
+    with ThreadPoolExecutor(max_workers=min(num_threads, len(idxs))) as pool:
+        return list(pool.map(ds.__getitem__, idxs))
 
 class MultiLabelDataFrameImageDataset(Dataset):
     '''Build an image dataset from a dataframe.
@@ -42,16 +311,45 @@ class MultiLabelDataFrameImageDataset(Dataset):
         List of unique label names. Order of list determines what integer a label is mapped to.
         If None, ´self.label_names´ are determined by ´self.label´.
 
+    cache_dir : str; optional
+        If set, decoded images are cached in this directory (see ´ImageCache´) and
+        read from the memory-mapped cache instead of being decoded at every access.
+
+    cache_img_size : int or tuple; optional
+        If set, images are resized to this size before they are cached.
+
+    cache_num_threads : int; optional
+        Number of threads that decode images when the cache is built.
+
+    load_size : int or tuple; optional
+        If set, JPEGs are decoded at the smallest reduced resolution (1/2, 1/4 or 1/8) that
+        is still at least ´load_size´ (see ´read_img´). Set it to the size of the final resize
+        of ´img_transform´ to skip decoding pixels that are thrown away by the resize anyway.
+        Note that transforms in front of the resize will see the smaller images.
+
+    decoder : str or callable; optional
+        Decoder used to read images (´opencv´, ´pil´, ´torchvision´, ´turbojpeg´ or a callable, see ´read_img´).
+
+    unknown_label : int; optional
+        If None, labels that are not part of the class names raise a KeyError. Otherwise they are
+        encoded as ´unknown_label´, e.g. -1 (negative values are decoded as None and not counted),
+        which can be ignored by the loss with ´ignore_index=-1´.
+
     Attributes
     ----------
+    imgs : np.ndarray
+        Image paths packed into a single numpy string array.
+
+    targets : np.ndarray
+        Integer encoded labels of shape (number of images, number of label columns).
+        Labels that are not part of the class names of a label column are encoded as ´unknown_label´.
+        Label statistics (see ´label_counts´) are cached until ´targets´ is set again.
+
     label_to_int : dict
-        Mapping between label names and integers.
+        Mapping between label names and integers for every label column.
 
     int_to_label : dict
-        Mapping between integers and labels.
-
-    num_labels : int
-        Number of unique labels
+        Mapping between integers and labels for every label column.
     '''
     def __init__(
         self,
@@ -60,27 +358,45 @@ class MultiLabelDataFrameImageDataset(Dataset):
         label_cols,
         root="./",
         img_transform=None,
-        label_class_names=None
+        label_class_names=None,
+        cache_dir=None,
+        cache_img_size=None,
+        cache_num_threads=8,
+        load_size=None,
+        decoder="opencv",
+        unknown_label=None
     ):
-        self.imgs = list(df[img_col])
+        # a single numpy array instead of a list of str objects, whose refcounts would dirty (and thus copy)
+        # memory pages in forked dataloader workers
+        self.imgs = np.array(list(df[img_col]), dtype=np.str_)
         self.label_cols = label_cols if isinstance(label_cols, list) else [label_cols,] # listify
         self.root = root
         self.img_transform = img_transform
+        self.load_size = load_size
+        self.decoder = decoder
+        self.img_cache = None
+        if cache_dir is not None:
+            self.img_cache = ImageCache(cache_dir, img_size=cache_img_size, decoder=decoder)
+            self.img_cache.build([os.path.join(self.root, img) for img in self.imgs], num_threads=cache_num_threads)
         label_class_names = label_class_names if isinstance(label_class_names, list) else [label_class_names,] # listiy
 
         # create additional attributes
-        self.labels = dict()
         self.label_class_names = dict()
         self.label_to_int = dict()
         self.int_to_label = dict()
+        targets = list()
         for idx, label_col in enumerate(self.label_cols):
-            self.labels[label_col] = list(df[label_col]) if label_col is not None else [0,]*len(self.imgs)
+            labels = list(df[label_col]) if label_col is not None else [0,]*len(self.imgs)
             if idx < len(label_class_names) and label_class_names[idx] is not None:
                 self.label_class_names[label_col] = label_class_names[idx]
             else:
-                self.label_class_names[label_col] = sorted(set(self.labels[label_col]))
+                self.label_class_names[label_col] = sorted(set(labels))
             self.label_to_int[label_col] = {k:v for v, k in enumerate(self.label_class_names[label_col])}
             self.int_to_label[label_col] = {v:k for k, v in self.label_to_int[label_col].items()}
+            targets.append(_encode_labels(labels, self.label_class_names[label_col], unknown_label))
+        self.unknown_label = unknown_label
+        self.targets = np.stack(targets, axis=1) # encoded once, shape (n_imgs, n_labels)
+        self._img_sizes = dict()
 
         self.n_labels = len(self.label_cols) # how many labels/targets there are
         self.classes_per_label = {k:len(v) for k, v in self.label_class_names.items()} # how many distinct classes for each label
@@ -88,26 +404,86 @@ class MultiLabelDataFrameImageDataset(Dataset):
     def __len__(self):
         return len(self.imgs)
 
-    def __getitem__(self, idx):
-        img = cv2.imread(os.path.join(self.root, self.imgs[idx]))
-        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    def load_img(self, idx):
+        '''Load image as RGB numpy array (from the image cache if one is used)'''
+        path = os.path.join(self.root, self.imgs[idx])
+        if self.img_cache is not None:
+            return self.img_cache.load(path)
+        return read_img(path, min_size=self.load_size, decoder=self.decoder)
+
+    @property
+    def labels(self):
+        '''Dict with the (decoded) labels of every label column, decoded once. Setting it encodes the labels into ´targets´.'''
+        if self._labels is None:
+            self._labels = {label_col: _decode_labels(self.targets[:, idx], self.label_class_names[label_col])
+                            for idx, label_col in enumerate(self.label_cols)}
+        return self._labels
+
+    @labels.setter
+    def labels(self, labels):
+        self.targets = np.stack([_encode_labels(labels[label_col], self.label_class_names[label_col], self.unknown_label)
+                                 for label_col in self.label_cols], axis=1)
+
+    @property
+    def targets(self):
+        return self._targets
+
+    @targets.setter
+    def targets(self, targets):
+        self._targets = targets
+        self._labels = None # cached labels and statistics are only valid for these targets
+        self._label_counts = None
+
+    def label_counts(self, label_col=None):
+        '''Number of images per class of ´label_col´ (dict of all label columns if None), computed once'''
+        if self._label_counts is None:
+            self._label_counts = dict()
+            for idx, label_col_ in enumerate(self.label_cols):
+                counts = _class_counts(self.targets[:, idx], len(self.label_class_names[label_col_]))
+                self._label_counts[label_col_] = dict(zip(self.label_class_names[label_col_], counts.tolist()))
+        if label_col is None:
+            return self._label_counts
+        return self._label_counts[label_col]
+
+    def read_img_size(self, idx):
+        '''(width, height) of an image, only the image header is read'''
+        with PIL.Image.open(os.path.join(self.root, self.imgs[idx])) as img:
+            return img.size
+
+    def img_sizes(self, n=100, num_threads=8, random_state=115):
+        '''Width and height of ´n´ random images (all if None), read in parallel and cached'''
+        if (n, random_state) not in self._img_sizes:
+            self._img_sizes[(n, random_state)] = _sample_img_sizes(self, n, num_threads, random_state)
+        return self._img_sizes[(n, random_state)]
 
-        multi_label = tuple()
-        for label_col, labels in self.labels.items():
-            multi_label = multi_label + (self.label_to_int[label_col][labels[idx]],)
+    def __getitem__(self, idx):
+        img = self.load_img(idx)
 
         if self.img_transform:
             img = self.img_transform(image=img)["image"]
 
-        return (img,) + multi_label
+        return (img,) + tuple(self.targets[idx].tolist())
+
+    def __getitems__(self, idxs):
+        '''Batched version of ´__getitem__´ used by the ´DataLoader´, labels of all items are fetched at once as tensor'''
+        multi_labels = torch.from_numpy(self.targets[idxs])
+        items = list()
+        for idx, multi_label in zip(idxs, multi_labels):
+            img = self.load_img(idx)
+            if self.img_transform:
+                img = self.img_transform(image=img)["image"]
+            items.append((img,) + tuple(multi_label))
+        return items
 
     def __repr__(self):
         info = ""
         info += f"Number of images\t: {self.__len__()}\n"
-        for label_col, label_to_int in self.label_to_int.items():
-            info += f"\nNumber of '{label_col}' labels\t: {len(label_to_int)}\n"
-            for k, v in label_to_int.items():
-                info += f"-> {k} ({Counter(self.labels[label_col])[k]})\n"
+        for label_col, counts in self.label_counts().items():
+            info += f"\nNumber of '{label_col}' labels\t: {len(counts)}\n"
+            for k, v in counts.items():
+                info += f"-> {k} ({v})\n"
+        if self.img_cache is not None:
+            info += f"\nImage cache\t: {self.img_cache.__repr__()}\n"
         if self.img_transform:
             info += "\nImage transformations:\n"
             info += f"{self.img_transform.__repr__()}\n"
@@ -115,18 +491,16 @@ class MultiLabelDataFrameImageDataset(Dataset):
 
     def get_labels(self):
         '''Label getter function required for compatibility with various modules (Balancer)'''
-        return self.labels[self.label_cols[0]] # defaults to first label type
-
-    def get_n_items(self, n, random=False):
-        idxs = np.arange(n)
-        if random:
-            idxs = np.random.choice(self.__len__(), n, replace=False)
+        return _decode_labels(self.targets[:, 0], self.label_class_names[self.label_cols[0]]) # defaults to first label type
 
-        items = list()
-        for idx in idxs:
-            items.append(self.__getitem__(idx))
+    def get_items(self, idxs, num_threads=8):
+        '''Items of ´idxs´ fetched in parallel threads (returned in the order of ´idxs´)'''
+        return _fetch_items(self, idxs, num_threads)
 
-        return items
+    def get_n_items(self, n, random=False, stratified=False, num_threads=8):
+        '''´n´ (random) items, if stratified classes (of the first label column) are sampled in turns'''
+        idxs = _sample_idxs(self.targets[:, 0], n, random, stratified)
+        return self.get_items(idxs, num_threads)
 
     def convert_to_pil_img(self, img):
         if isinstance(img, PIL.Image.Image):
@@ -138,8 +512,8 @@ class MultiLabelDataFrameImageDataset(Dataset):
         else:
             raise TypeError(f"Conversion from {type(img)} to pillow image not possible")
 
-    def show_n_items(self, n=9, random=False, figsize=(10, 10)):
-        items = self.get_n_items(n, random)
+    def show_n_items(self, n=9, random=False, stratified=False, figsize=(10, 10), num_threads=8):
+        items = self.get_n_items(n, random, stratified, num_threads)
         fig, axes = plt.subplots(math.ceil(n/3), 3, figsize=figsize)
         for ax, item in zip(axes.flatten(), items):
             img = self.convert_to_pil_img(item[0])
@@ -180,8 +554,39 @@ class DataFrameImageDataset(Dataset):
         List of unique label names. Order of list determines what integer a label is mapped to.
         If None, ´self.label_names´ are determined by ´self.label´.
 
+    cache_dir : str; optional
+        If set, decoded images are cached in this directory (see ´ImageCache´) and
+        read from the memory-mapped cache instead of being decoded at every access.
+
+    cache_img_size : int or tuple; optional
+        If set, images are resized to this size before they are cached.
+
+    cache_num_threads : int; optional
+        Number of threads that decode images when the cache is built.
+
+    load_size : int or tuple; optional
+        If set, JPEGs are decoded at the smallest reduced resolution (1/2, 1/4 or 1/8) that
+        is still at least ´load_size´ (see ´read_img´). Set it to the size of the final resize
+        of ´img_transform´ to skip decoding pixels that are thrown away by the resize anyway.
+        Note that transforms in front of the resize will see the smaller images.
+
+    decoder : str or callable; optional
+        Decoder used to read images (´opencv´, ´pil´, ´torchvision´, ´turbojpeg´ or a callable, see ´read_img´).
+
+    unknown_label : int; optional
+        If None, labels that are not part of the class names raise a KeyError. Otherwise they are
+        encoded as ´unknown_label´, e.g. -1 (negative values are decoded as None and not counted),
+        which can be ignored by the loss with ´ignore_index=-1´.
+
     Attributes
     ----------
+    imgs : np.ndarray
+        Image paths packed into a single numpy string array.
+
+    targets : np.ndarray
+        Integer encoded labels. Labels that are not part of ´label_names´ are encoded as ´unknown_label´.
+        Label statistics (see ´label_counts´) are cached until ´targets´ is set again.
+
     label_to_int : dict
         Mapping between label names and integers.
 
@@ -198,34 +603,108 @@ class DataFrameImageDataset(Dataset):
         label_col=None,
         root="./",
         img_transform=None,
-        label_names=None
+        label_names=None,
+        cache_dir=None,
+        cache_img_size=None,
+        cache_num_threads=8,
+        load_size=None,
+        decoder="opencv",
+        unknown_label=None
     ):
-        self.imgs = list(df[img_col])
-        self.labels = list(df[label_col]) if label_col is not None else [0,]*len(self.imgs)
+        # a single numpy array instead of a list of str objects, whose refcounts would dirty (and thus copy)
+        # memory pages in forked dataloader workers
+        self.imgs = np.array(list(df[img_col]), dtype=np.str_)
+        labels = list(df[label_col]) if label_col is not None else [0,]*len(self.imgs)
         self.root = root
         self.img_transform = img_transform
-        self.label_names = label_names if label_names is not None else sorted(set(self.labels))
+        self.load_size = load_size
+        self.decoder = decoder
+        self.img_cache = None
+        if cache_dir is not None:
+            self.img_cache = ImageCache(cache_dir, img_size=cache_img_size, decoder=decoder)
+            self.img_cache.build([os.path.join(self.root, img) for img in self.imgs], num_threads=cache_num_threads)
+        self.label_names = label_names if label_names is not None else sorted(set(labels))
         self.label_to_int = {k:v for v, k in enumerate(self.label_names)}
         self.int_to_label = {v: k for k, v in self.label_to_int.items()}
         self.num_labels = len(self.label_names)
+        self.unknown_label = unknown_label
+        self.targets = _encode_labels(labels, self.label_names, unknown_label) # encoded once
+        self._img_sizes = dict()
 
     def __len__(self):
         return len(self.imgs)
 
+    def load_img(self, idx):
+        '''Load image as RGB numpy array (from the image cache if one is used)'''
+        path = os.path.join(self.root, self.imgs[idx])
+        if self.img_cache is not None:
+            return self.img_cache.load(path)
+        return read_img(path, min_size=self.load_size, decoder=self.decoder)
+
+    @property
+    def labels(self):
+        '''(Decoded) labels of all images, decoded once. Setting them encodes the labels into ´targets´.'''
+        if self._labels is None:
+            self._labels = _decode_labels(self.targets, self.label_names)
+        return self._labels
+
+    @labels.setter
+    def labels(self, labels):
+        self.targets = _encode_labels(labels, self.label_names, self.unknown_label)
+
+    @property
+    def targets(self):
+        return self._targets
+
+    @targets.setter
+    def targets(self, targets):
+        self._targets = targets
+        self._labels = None # cached labels and statistics are only valid for these targets
+        self._label_counts = None
+
+    def label_counts(self):
+        '''Number of images per label, computed once'''
+        if self._label_counts is None:
+            self._label_counts = dict(zip(self.label_names, _class_counts(self.targets, self.num_labels).tolist()))
+        return self._label_counts
+
+    def read_img_size(self, idx):
+        '''(width, height) of an image, only the image header is read'''
+        with PIL.Image.open(os.path.join(self.root, self.imgs[idx])) as img:
+            return img.size
+
+    def img_sizes(self, n=100, num_threads=8, random_state=115):
+        '''Width and height of ´n´ random images (all if None), read in parallel and cached'''
+        if (n, random_state) not in self._img_sizes:
+            self._img_sizes[(n, random_state)] = _sample_img_sizes(self, n, num_threads, random_state)
+        return self._img_sizes[(n, random_state)]
+
     def __getitem__(self, idx):
-        img = cv2.imread(os.path.join(self.root, self.imgs[idx]))
-        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-        label = self.label_to_int[self.labels[idx]]
+        img = self.load_img(idx)
+        label = self.targets[idx].item()
         if self.img_transform:
             img = self.img_transform(image=img)["image"]
         return img, label
 
+    def __getitems__(self, idxs):
+        '''Batched version of ´__getitem__´ used by the ´DataLoader´, labels of all items are fetched at once as tensor'''
+        labels = torch.from_numpy(self.targets[idxs])
+        items = list()
+        for idx, label in zip(idxs, labels):
+            img = self.load_img(idx)
+            if self.img_transform:
+                img = self.img_transform(image=img)["image"]
+            items.append((img, label))
+        return items
+
     def __repr__(self):
         info = ""
         info += f"Number of images\t: {self.__len__()}\n"
         info += f"Number of labels\t: {len(self.label_to_int)}\n"
-        for k, v in self.label_to_int.items():
-            info += f"-> {k} ({Counter(self.labels)[k]})\n"
+        for k, v in self.label_counts().items():
+            info += f"-> {k} ({v})\n"
+        if self.img_cache is not None:
+            info += f"\nImage cache\t: {self.img_cache.__repr__()}\n"
         if self.img_transform:
             info += "\nImage transformations:\n"
             info += f"{self.img_transform.__repr__()}\n"
@@ -235,16 +714,14 @@ class DataFrameImageDataset(Dataset):
         '''Label getter function required for compatibility with various modules'''
         return self.labels
 
-    def get_n_items(self, n, random=False):
-        idxs = np.arange(n)
-        if random:
-            idxs = np.random.choice(self.__len__(), n, replace=False)
+    def get_items(self, idxs, num_threads=8):
+        '''Items of ´idxs´ fetched in parallel threads (returned in the order of ´idxs´)'''
+        return _fetch_items(self, idxs, num_threads)
 
-        items = list()
-        for idx in idxs:
-            items.append(self.__getitem__(idx))
-
-        return items
+    def get_n_items(self, n, random=False, stratified=False, num_threads=8):
+        '''´n´ (random) items, if stratified classes are sampled in turns'''
+        idxs = _sample_idxs(self.targets, n, random, stratified)
+        return self.get_items(idxs, num_threads)
 
     def convert_to_pil_img(self, img):
         if isinstance(img, PIL.Image.Image):
@@ -256,8 +733,8 @@ class DataFrameImageDataset(Dataset):
         else:
             raise TypeError(f"Conversion from {type(img)} to pillow image not possible")
 
-    def show_n_items(self, n=9, random=False, figsize=(10, 10)):
-        items = self.get_n_items(n, random)
+    def show_n_items(self, n=9, random=False, stratified=False, figsize=(10, 10), num_threads=8):
+        items = self.get_n_items(n, random, stratified, num_threads)
         fig, axes = plt.subplots(math.ceil(n/3), 3, figsize=figsize)
         for ax, item in zip(axes.flatten(), items):
             img, label = self.convert_to_pil_img(item[0]), self.int_to_label[item[1]]
@@ -0,0 +1,191 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: nb_data.decoder.ipynb (unless otherwise specified).
+
+__all__ = ['reduction_factor', 'decode_opencv', 'decode_pil', 'decode_torchvision', 'TurboJPEGDecoder', 'get_decoder',
+           'read_img', 'decoders', 'benchmark_decoders', 'benchmark_decoders_cli']
+
+# Cell
+import os
+import io
+import time
+import argparse
+import numpy as np
+import pandas as pd
+import cv2
+from PIL import Image, ImageOps
+import torch
+from torchvision.io import decode_image, ImageReadMode
+
+# Cell
+_REDUCED_FLAGS = {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
+_IMREAD_COLOR_RGB = getattr(cv2, "IMREAD_COLOR_RGB", None) # only available in newer OpenCV versions
+_EXIF_ORIENTATION = 0x0112
+
+def _reduction_factor(img, min_size):
+    '''´reduction_factor´ of an opened PIL image'''
+    if min_size is None or img.format != "JPEG":
+        return 1
+    if isinstance(min_size, int):
+        min_size = (min_size, min_size)
+    width, height = img.size
+    if img.getexif().get(_EXIF_ORIENTATION, 1) in [5, 6, 7, 8]: # EXIF orientation swaps width and height
+        width, height = height, width
+    for factor in [8, 4, 2]:
+        # libjpeg rounds scaled sizes up
+        if -(-width//factor) >= min_size[0] and -(-height//factor) >= min_size[1]:
+            return factor
+    return 1
+
+def _open(src):
+    '''Open a path or the bytes of an image file with PIL (lazily, only the header is read)'''
+    return Image.open(src if isinstance(src, str) else io.BytesIO(src))
+
+def reduction_factor(src, min_size):
+    '''Largest JPEG scale denominator (1, 2, 4 or 8) at which the image is still at least ´min_size´
+
+    Only the image header is read. Images that are not JPEGs always return 1.
+    '''
+    with _open(src) as img:
+        return _reduction_factor(img, min_size)
+
+def decode_opencv(src, min_size=None):
+    '''Decode with ´cv2.imread´/´cv2.imdecode´ (´cv2.IMREAD_REDUCED_COLOR_*´ for reduced JPEG decoding)
+
+    If OpenCV supports it, images are decoded directly into RGB instead of converting from BGR.
+    '''
+    flag = _REDUCED_FLAGS[1 if min_size is None else reduction_factor(src, min_size)]
+    if _IMREAD_COLOR_RGB is not None:
+        flag = (flag & ~cv2.IMREAD_COLOR) | _IMREAD_COLOR_RGB
+    if isinstance(src, str):
+        img = cv2.imread(src, flag)
+    else:
+        img = cv2.imdecode(np.frombuffer(src, dtype=np.uint8), flag)
+    if img is None:
+        raise FileNotFoundError(f"Image '{src if isinstance(src, str) else 'from bytes'}' could not be read")
+    if _IMREAD_COLOR_RGB is None:
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    return img
+
+def decode_pil(src, min_size=None):
+    '''Decode with PIL (or a drop-in replacement like Pillow-SIMD), ´Image.draft´ for reduced JPEG decoding
+
+    The EXIF orientation is applied like with OpenCV. The returned array is read-only.
+    '''
+    with _open(src) as img:
+        factor = _reduction_factor(img, min_size)
+        if factor > 1:
+            img.draft("RGB", (-(-img.size[0]//factor), -(-img.size[1]//factor)))
+        orientation = img.getexif().get(_EXIF_ORIENTATION, 1)
+        img = img.convert("RGB")
+    if orientation != 1:
+        img = ImageOps.exif_transpose(img)
+    return np.asarray(img)
+
+def decode_torchvision(src, min_size=None):
+    '''Decode with ´torchvision.io.decode_image´ (libjpeg-turbo/libpng), ´min_size´ is ignored'''
+    if not isinstance(src, str):
+        src = torch.frombuffer(bytearray(src), dtype=torch.uint8)
+    img = decode_image(src, mode=ImageReadMode.RGB, apply_exif_orientation=True)
+    return np.ascontiguousarray(img.permute(1, 2, 0).numpy())
+
+class TurboJPEGDecoder():
+    '''Decode JPEGs with PyTurboJPEG (scaled decoding for reduced JPEG decoding)
+
+    Requires ´PyTurboJPEG´ and a libturbojpeg shared library. Other formats are decoded
+    with ´decode_opencv´. Note that the EXIF orientation is not applied.
+
+    Parameters
+    ----------
+    lib_path : str; optional
+        Path to a local libturbojpeg library. If None, the environment variable
+        ´TURBOJPEG_LIB´ is used and otherwise the library is searched in default locations.
+    '''
+    def __init__(self, lib_path=None):
+        self.lib_path = lib_path if lib_path is not None else os.environ.get("TURBOJPEG_LIB")
+        self._jpeg = None
+
+    @property
+    def jpeg(self):
+        if self._jpeg is None: # loaded lazily in every process
+            from turbojpeg import TurboJPEG
+            self._jpeg = TurboJPEG(self.lib_path)
+        return self._jpeg
+
+    def __call__(self, src, min_size=None):
+        with _open(src) as img:
+            if img.format != "JPEG":
+                return decode_opencv(src, min_size)
+            factor = _reduction_factor(img, min_size)
+        from turbojpeg import TJPF_RGB
+        if isinstance(src, str):
+            with open(src, "rb") as f:
+                src = f.read()
+        return self.jpeg.decode(src, pixel_format=TJPF_RGB, scaling_factor=(1, factor))
+
+    def __getstate__(self):
+        return {"lib_path": self.lib_path, "_jpeg": None}
+
+decoders = {
+    "opencv": decode_opencv,
+    "pil": decode_pil,
+    "torchvision": decode_torchvision,
+    "turbojpeg": TurboJPEGDecoder(),
+}
+
+def get_decoder(decoder):
+    '''Get a decoder by name (see ´decoders´) or return ´decoder´ if it already is a callable'''
+    if callable(decoder):
+        return decoder
+    if decoder not in decoders:
+        raise ValueError(f"Unknown decoder '{decoder}', should be one of {list(decoders)} or a callable")
+    return decoders[decoder]
+
+def read_img(src, min_size=None, decoder="opencv"):
+    '''Read an image from disk (´src´ is a path) or from memory (´src´ are the bytes of an image file) as RGB numpy array
+
+    If ´min_size´ (int or (width, height)) is set, JPEGs are decoded directly at a reduced
+    resolution (1/2, 1/4 or 1/8, computed in the DCT domain by libjpeg) as long as the
+    decoded image is still at least ´min_size´ (see ´reduction_factor´). This is several
+    times faster and needs less memory than decoding at full resolution and resizing afterwards.
+    '''
+    return get_decoder(decoder)(src, min_size)
+
+# Cell
+def benchmark_decoders(img_dir, decoder_names=None, min_size=None, max_imgs=200, exts=(".jpg", ".jpeg", ".png")):
+    '''Measure images/sec of decoders on (up to ´max_imgs´) images in ´img_dir´
+
+    Every image is read once before the measurement so that all decoders read from the page cache.
+    Decoders that are not available on this machine are reported with their error.
+    '''
+    paths = sorted(os.path.join(img_dir, f) for f in os.listdir(img_dir) if f.lower().endswith(tuple(exts)))[:max_imgs]
+    if len(paths) == 0:
+        raise ValueError(f"No images with extension {exts} found in '{img_dir}'")
+    for path in paths:
+        with open(path, "rb") as f:
+            f.read()
+
+    results = list()
+    for decoder_name in decoder_names if decoder_names is not None else list(decoders):
+        decoder = get_decoder(decoder_name)
+        result = {"decoder": decoder_name, "n_imgs": len(paths), "seconds": np.nan, "imgs_per_sec": np.nan, "error": None}
+        try:
+            decoder(paths[0], min_size) # warm-up (e.g. loading of libraries)
+            start = time.perf_counter()
+            for path in paths:
+                decoder(path, min_size)
+            result["seconds"] = time.perf_counter() - start
+            result["imgs_per_sec"] = len(paths)/result["seconds"]
+        except Exception as e:
+            result["error"] = repr(e)
+        results.append(result)
+
+    return pd.DataFrame(results)
+
+def benchmark_decoders_cli():
+    '''Command line interface of ´benchmark_decoders´'''
+    parser = argparse.ArgumentParser(description="Measure images/sec of image decoders on a directory of images")
+    parser.add_argument("img_dir", help="Directory containing JPEG/PNG images")
+    parser.add_argument("--decoders", nargs="+", default=None, help=f"Decoders to benchmark (default: {list(decoders)})")
+    parser.add_argument("--min_size", type=int, default=None, help="Minimum size for reduced JPEG decoding")
+    parser.add_argument("--max_imgs", type=int, default=200, help="Maximum number of images")
+    args = parser.parse_args()
+    print(benchmark_decoders(args.img_dir, args.decoders, args.min_size, args.max_imgs).to_string(index=False))
\ No newline at end of file
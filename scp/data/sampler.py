@@ -0,0 +1,110 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: nb_data.sampler.ipynb (unless otherwise specified).
+
+__all__ = ['BalancedSampler']
+
+# Cell
+import numpy as np
+import torch.distributed as dist
+from torch.utils.data import DistributedSampler
+from ..train.balance import group_by_class, sample_class_idxs
+
+class BalancedSampler(DistributedSampler):
+    '''Sample a class balanced epoch from integer (or any hashable) labels.
+
+    Row positions per class are computed once. For every epoch, classes are resampled with the
+    strategies of ´scp.train.balance´ (see ´balance_idxs´) and the resulting indices are shuffled.
+    Sampling only depends on ´seed´ and the epoch, hence all processes draw the same epoch and
+    every process iterates over its own shard of it (like ´DistributedSampler´).
+
+    The sampler is a ´DistributedSampler´, hence Lightning's DDP (with ´replace_sampler_ddp=True´) neither
+    replaces it nor wraps it in a ´DistributedSamplerWrapper´, which would shard the already sharded
+    epoch a second time. Lightning calls ´set_epoch´ at the start of every epoch. As the sampler does not
+    index a dataset itself, its ´dataset´ attribute only is a placeholder with the length of an epoch.
+
+    Parameters
+    ----------
+    labels : 1d array-like
+        Label of every item in the dataset
+
+    strategy : str; optional
+        ´downsample´ (all classes to at most ´size´), ´upsample´ (all classes to at least ´size´)
+        or ´balance´ (all classes to exactly ´size´)
+
+    size : int; optional
+        Class size. Defaults to the smallest class (´downsample´), the largest class (´upsample´)
+        or the dataset size divided by the number of classes (´balance´).
+
+    shuffle : bool; optional
+        Whether to shuffle the indices of an epoch
+
+    seed : int; optional
+        Random seed shared by all processes
+
+    num_replicas : int; optional
+        Number of processes. Determined by ´torch.distributed´ if None.
+
+    rank : int; optional
+        Rank of this process. Determined by ´torch.distributed´ if None.
+    '''
+    def __init__(self, labels, strategy:str="balance", size:int=None, shuffle:bool=True, seed:int=115,
+                 num_replicas:int=None, rank:int=None):
+        self.order, counts = group_by_class(labels)
+        self.counts = counts[:-1] # items with a missing label are not sampled
+        self.order = self.order[:self.counts.sum()]
+        if len(self.counts) == 0:
+            raise ValueError("Cannot balance an epoch as no item has a label")
+
+        if strategy == "downsample":
+            size = self.counts.min() if size is None else size
+            self.sizes = np.minimum(self.counts, size)
+        elif strategy == "upsample":
+            size = self.counts.max() if size is None else size
+            self.sizes = np.maximum(self.counts, size)
+        elif strategy == "balance":
+            size = len(self.order) // len(self.counts) if size is None else size
+            self.sizes = np.full_like(self.counts, size)
+        else:
+            raise ValueError(f"Unknown strategy {strategy}")
+
+        # ´DistributedSampler´ requires an initialized process group to determine the defaults
+        distributed = dist.is_available() and dist.is_initialized()
+        num_replicas = num_replicas if num_replicas is not None else (dist.get_world_size() if distributed else 1)
+        rank = rank if rank is not None else (dist.get_rank() if distributed else 0)
+        super().__init__(range(int(self.sizes.sum())), num_replicas=num_replicas, rank=rank, shuffle=shuffle, seed=seed)
+        self.strategy = strategy
+
+    @classmethod
+    def from_dataset(cls, ds, **kwargs):
+        '''Create sampler from the encoded labels (´targets´) of a dataset (e.g. ´DataFrameImageDataset´)
+
+        The first label column is used for multi-label datasets, negative targets (unknown labels) are not sampled.
+        '''
+        targets = np.asarray(ds.targets)
+        if targets.ndim == 2:
+            targets = targets[:, 0]
+        return cls(np.where(targets < 0, np.nan, targets), **kwargs)
+
+    def set_epoch(self, epoch:int):
+        self.epoch = epoch
+
+    def epoch_idxs(self, epoch:int):
+        '''All indices of an epoch (before sharding across processes)'''
+        rng = np.random.default_rng([self.seed, epoch])
+        idxs = sample_class_idxs(self.order, self.counts, self.sizes, rng)
+        if self.shuffle:
+            idxs = idxs[rng.permutation(len(idxs))]
+        return idxs
+
+    def __iter__(self):
+        idxs = self.epoch_idxs(self.epoch)
+        self.epoch += 1 # draw a new epoch even if ´set_epoch´ is never called
+
+        # pad (by repeating indices) to be evenly divisible by the number of processes
+        padding = self.total_size - len(idxs)
+        if padding > 0:
+            idxs = np.concatenate([idxs, np.resize(idxs, padding)])
+
+        return iter(idxs[self.rank::self.num_replicas].tolist())
+
+    def __len__(self):
+        return self.num_samples
\ No newline at end of file
@@ -0,0 +1,292 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: nb_data.shards.ipynb (unless otherwise specified).
+
+__all__ = ['write_shards', 'read_shard_index', 'ShardReader', 'ShardedImageDataset', 'ShardedIterableImageDataset',
+           'EpochDataLoader']
+
+# Cell
+import os
+import io
+import json
+import math
+import tarfile
+import numpy as np
+import pandas as pd
+import PIL.Image
+import torch.distributed as dist
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from torch.utils.data import DataLoader, IterableDataset, get_worker_info
+from .dataset import DataFrameImageDataset
+from .decoder import read_img
+
+# Cell
+_LOC_COLS = ["key", "shard", "offset", "size"]
+
+def _shard_file(shard_dir, shard):
+    return os.path.join(shard_dir, f"shard_{shard:05d}.tar")
+
+def _add_to_tar(tar, name, data):
+    '''Add ´data´ (bytes) as file ´name´ to ´tar´ and return the offset of the data in the tar file'''
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    tar.addfile(info, io.BytesIO(data))
+    return tar.offset - math.ceil(len(data)/tarfile.BLOCKSIZE)*tarfile.BLOCKSIZE # data is padded to full blocks
+
+def _read_file(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+def write_shards(df, img_col, shard_dir, root="./", max_shard_size=1000, max_shard_bytes=256*2**20, num_threads=8):
+    '''Pack the image files of ´df´ into tar shards in ´shard_dir´ and write an index.
+
+    Images are stored in the order of ´df´. A new shard is started after ´max_shard_size´ images or
+    when a shard would exceed ´max_shard_bytes´. Image files are read with ´num_threads´ threads.
+
+    Returns
+    -------
+    The index: ´df´ (with reset index) plus the columns ´key´, ´shard´, ´offset´ and ´size´
+    (position of the image bytes in the shards).
+    '''
+    if any(col in df.columns for col in _LOC_COLS):
+        raise ValueError(f"Column names {_LOC_COLS} are reserved for the shard index")
+    os.makedirs(shard_dir, exist_ok=True)
+    df = df.reset_index(drop=True)
+    rows = df.to_dict("records")
+
+    locs = list()
+    shard, shard_size, shard_bytes, tar = -1, 0, 0, None
+    with ThreadPoolExecutor(max_workers=num_threads) as pool:
+        for start in range(0, len(df), max_shard_size):
+            paths = [os.path.join(root, path) for path in df[img_col].iloc[start:start+max_shard_size]]
+            for key, path, data in zip(range(start, start+len(paths)), paths, pool.map(_read_file, paths)):
+                if tar is None or shard_size >= max_shard_size or (shard_size > 0 and shard_bytes + len(data) > max_shard_bytes):
+                    if tar is not None:
+                        tar.close()
+                    shard, shard_size, shard_bytes = shard + 1, 0, 0
+                    tar = tarfile.open(_shard_file(shard_dir, shard), "w", format=tarfile.USTAR_FORMAT)
+
+                ext = os.path.splitext(path)[1].lstrip(".").lower() or "img"
+                _add_to_tar(tar, f"{key:09d}.json", json.dumps(rows[key], default=str).encode())
+                offset = _add_to_tar(tar, f"{key:09d}.{ext}", data)
+                locs.append((key, shard, offset, len(data)))
+                shard_size, shard_bytes = shard_size + 1, tar.offset
+    if tar is not None:
+        tar.close()
+
+    index = pd.concat([df, pd.DataFrame(locs, columns=_LOC_COLS)], axis=1)
+    # csv does not keep dtypes (e.g. string labels "0"/"1" would be read as ints), hence they are stored separately
+    with open(os.path.join(shard_dir, "index_dtypes.json"), "w") as f:
+        json.dump({col: str(dtype) for col, dtype in index.dtypes.items()}, f)
+    # the index is written last, hence an existing index means that all shards are complete
+    index.to_csv(os.path.join(shard_dir, "index.tmp.csv"), index=False)
+    os.replace(os.path.join(shard_dir, "index.tmp.csv"), os.path.join(shard_dir, "index.csv"))
+    return index
+
+def read_shard_index(shard_dir):
+    '''Read the index written by ´write_shards´ with the original column dtypes'''
+    dtypes_path = os.path.join(shard_dir, "index_dtypes.json")
+    if not os.path.exists(dtypes_path): # index of an older version, dtypes are inferred
+        return pd.read_csv(os.path.join(shard_dir, "index.csv"))
+    with open(dtypes_path) as f:
+        dtypes = json.load(f)
+    dates = [col for col, dtype in dtypes.items() if dtype.startswith("datetime")]
+    index = pd.read_csv(os.path.join(shard_dir, "index.csv"), parse_dates=dates,
+                        dtype={col: dtype for col, dtype in dtypes.items() if col not in dates})
+    return index[list(dtypes)]
+
+class ShardReader():
+    '''Read byte ranges from the shard files of ´shard_dir´
+
+    File descriptors are opened lazily and per process, hence a reader can be used in dataloader workers.
+    '''
+    def __init__(self, shard_dir):
+        self.shard_dir = shard_dir
+        self._fds = dict()
+
+    def read(self, shard, offset, size):
+        if shard not in self._fds:
+            self._fds[shard] = os.open(_shard_file(self.shard_dir, shard), os.O_RDONLY)
+        return os.pread(self._fds[shard], int(size), int(offset))
+
+    def close(self):
+        for fd in self._fds.values():
+            os.close(fd)
+        self._fds = dict()
+
+    def __getstate__(self):
+        return {"shard_dir": self.shard_dir, "_fds": dict()}
+
+    def __del__(self):
+        self.close()
+
+# Cell
+class ShardedImageDataset(DataFrameImageDataset):
+    '''´DataFrameImageDataset´ which reads images from shards written by ´write_shards´
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Shard index (see ´read_shard_index´) or a subset of it
+
+    shard_dir : str
+        Directory containing the shards
+
+    All other parameters are the same as for ´DataFrameImageDataset´ (´img_col´ is only
+    used for display, images are located by the columns ´shard´, ´offset´ and ´size´).
+    '''
+    def __init__(self, df, img_col, shard_dir, label_col=None, img_transform=None, label_names=None, load_size=None, decoder="opencv",
+                 unknown_label=None):
+        super().__init__(df, img_col, label_col=label_col, root=shard_dir, img_transform=img_transform,
+                         label_names=label_names, load_size=load_size, decoder=decoder, unknown_label=unknown_label)
+        self.shard_dir = shard_dir
+        self.locs = df[["shard", "offset", "size"]].to_numpy(dtype=np.int64)
+        self.reader = ShardReader(shard_dir)
+
+    def read_bytes(self, idx):
+        '''Encoded image file of item ´idx´'''
+        return self.reader.read(*self.locs[idx])
+
+    def load_img(self, idx, buf=None):
+        '''Load image as RGB numpy array (decoded from ´buf´ if the bytes have already been read)'''
+        if buf is None:
+            buf = self.read_bytes(idx)
+        return read_img(buf, min_size=self.load_size, decoder=self.decoder)
+
+    def read_img_size(self, idx):
+        '''(width, height) of an image, only the image header is decoded'''
+        with PIL.Image.open(io.BytesIO(self.read_bytes(idx))) as img:
+            return img.size
+
+class ShardedIterableImageDataset(IterableDataset):
+    '''Iterate over a ´ShardedImageDataset´ shard by shard with sequential reads
+
+    Every epoch, the order of the shards is shuffled and the samples (in shard order) are split
+    into contiguous blocks for every process (padded like with ´DistributedSampler´) and for
+    every dataloader worker. Thus, every worker reads one or a few shards sequentially while a
+    background thread reads up to ´prefetch´ images ahead. Samples are shuffled within a buffer
+    of ´shuffle_buffer´ samples, hence shards should be much larger than the shuffle buffer
+    but there should still be many more shards than processes times workers.
+
+    Parameters
+    ----------
+    ds : ShardedImageDataset
+        Map-style dataset that is read sequentially
+
+    shuffle : bool; optional
+        Whether to shuffle shards and samples
+
+    shuffle_buffer : int; optional
+        Number of samples in the shuffle buffer
+
+    prefetch : int; optional
+        Number of images which are read ahead
+
+    seed : int; optional
+        Random seed shared by all processes
+
+    num_replicas : int; optional
+        Number of processes. Determined by ´torch.distributed´ if None.
+
+    rank : int; optional
+        Rank of this process. Determined by ´torch.distributed´ if None.
+    '''
+    def __init__(self, ds, shuffle=True, shuffle_buffer=1000, prefetch=64, seed=115, num_replicas=None, rank=None):
+        self.ds = ds
+        self.shuffle = shuffle
+        self.shuffle_buffer = shuffle_buffer
+        self.prefetch = prefetch
+        self.seed = seed
+        self.epoch = 0
+        distributed = dist.is_available() and dist.is_initialized()
+        self.num_replicas = num_replicas if num_replicas is not None else (dist.get_world_size() if distributed else 1)
+        self.rank = rank if rank is not None else (dist.get_rank() if distributed else 0)
+        self.num_samples = math.ceil(len(ds) / self.num_replicas)
+
+    def set_epoch(self, epoch:int):
+        self.epoch = epoch
+
+    def get_labels(self):
+        return self.ds.get_labels()
+
+    def epoch_idxs(self, epoch:int):
+        '''Indices of this process in an epoch in reading order (shard by shard, sequential within shards)'''
+        rng = np.random.default_rng([self.seed, epoch])
+        shards = np.unique(self.ds.locs[:, 0])
+        if self.shuffle:
+            shards = shards[rng.permutation(len(shards))]
+
+        # all indices shard by shard in the (shuffled) shard order and sorted by offset within shards
+        shard_pos = np.empty(shards.max()+1 if len(shards) > 0 else 0, dtype=np.int64)
+        shard_pos[shards] = np.arange(len(shards))
+        idxs = np.lexsort((self.ds.locs[:, 1], shard_pos[self.ds.locs[:, 0]]))
+
+        # pad (by repeating indices) to be evenly divisible by the number of processes
+        padding = self.num_samples * self.num_replicas - len(idxs)
+        if padding > 0:
+            idxs = np.concatenate([idxs, np.resize(idxs, padding)])
+        return idxs[self.rank*self.num_samples:(self.rank+1)*self.num_samples]
+
+    def _read(self, idxs):
+        '''Yield (idx, bytes) while a thread sequentially reads ahead'''
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            futures = deque()
+            for idx in idxs:
+                futures.append((idx, pool.submit(self.ds.read_bytes, idx)))
+                if len(futures) > self.prefetch:
+                    idx, future = futures.popleft()
+                    yield idx, future.result()
+            while len(futures) > 0:
+                idx, future = futures.popleft()
+                yield idx, future.result()
+
+    def __iter__(self):
+        epoch = self.epoch
+        # next epoch even if ´set_epoch´ is never called. In dataloader workers this only changes a copy,
+        # use ´EpochDataLoader´ to advance the epoch in the main process.
+        self.epoch += 1
+        idxs = self.epoch_idxs(epoch)
+
+        worker_info = get_worker_info()
+        if worker_info is not None:
+            idxs = np.array_split(idxs, worker_info.num_workers)[worker_info.id]
+
+        rng = np.random.default_rng([self.seed, epoch, self.rank, 0 if worker_info is None else worker_info.id])
+        buffer = list()
+        for idx, buf in self._read(idxs.tolist()):
+            img = self.ds.load_img(idx, buf)
+            if self.ds.img_transform:
+                img = self.ds.img_transform(image=img)["image"]
+            item = (img, self.ds.targets[idx].item())
+            if not self.shuffle:
+                yield item
+            elif len(buffer) < self.shuffle_buffer:
+                buffer.append(item)
+            else:
+                # emit a random sample of the buffer and put the new one in its place
+                pos = rng.integers(len(buffer))
+                buffer[pos], item = item, buffer[pos]
+                yield item
+        rng.shuffle(buffer)
+        yield from buffer
+
+    def __len__(self):
+        return self.num_samples
+
+    def __repr__(self):
+        return f"ShardedIterableImageDataset(shuffle={self.shuffle}, shuffle_buffer={self.shuffle_buffer})\n{self.ds.__repr__()}"
+
+class EpochDataLoader(DataLoader):
+    '''´DataLoader´ which calls ´dataset.set_epoch´ in the main process at the start of every epoch
+
+    Dataloader workers get a copy of the dataset, hence an epoch counter which is advanced in
+    ´dataset.__iter__´ is lost when the workers are not persistent. The epoch starts at ´epoch´
+    (e.g. ´trainer.current_epoch´) and is increased on every iteration over the loader.
+    '''
+    def __init__(self, dataset, *args, epoch=0, **kwargs):
+        super().__init__(dataset, *args, **kwargs)
+        self.epoch = epoch
+
+    def __iter__(self):
+        self.dataset.set_epoch(self.epoch)
+        self.epoch += 1
+        return super().__iter__()
\ No newline at end of file
@@ -0,0 +1,260 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: nb_inference.embeddings.ipynb (unless otherwise specified).
+
+__all__ = ['EmbeddingStore', 'extract_embeddings', 'KNNIndex', 'knn_accuracy', 'linear_probe']
+
+# Cell
+import os
+import json
+import shutil
+import numpy as np
+import torch
+import torch.nn.functional as F
+from sklearn.linear_model import LogisticRegression
+
+# Cell
+class EmbeddingStore():
+    '''On-disk cache of extracted features and targets
+
+    Every entry is a directory ´<root>/<key>´ with ´feats.npy´, ´targets.npy´ and ´meta.json´.
+    Entries are written to a temporary directory first, hence incomplete extractions are never loaded.
+
+    Parameters
+    ----------
+    root : str
+        Directory of the store
+    '''
+    def __init__(self, root:str):
+        self.root = root
+        os.makedirs(self.root, exist_ok=True)
+
+    def path(self, key:str):
+        return os.path.join(self.root, key)
+
+    def __contains__(self, key:str):
+        return os.path.exists(os.path.join(self.path(key), "meta.json"))
+
+    def keys(self):
+        return sorted(os.path.relpath(d, self.root) for d, _, files in os.walk(self.root) if "meta.json" in files)
+
+    def load(self, key:str, mmap:bool=True):
+        '''Features, targets and meta data of an entry (features are memory-mapped by default)'''
+        path = self.path(key)
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        feats = np.load(os.path.join(path, "feats.npy"), mmap_mode="r" if mmap else None)
+        return feats, np.load(os.path.join(path, "targets.npy")), meta
+
+    def _tmp_path(self, key:str):
+        return self.path(key) + ".tmp"
+
+    def _commit(self, key:str, meta:dict):
+        tmp_path = self._tmp_path(key)
+        with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+            json.dump(meta, f)
+        if os.path.exists(self.path(key)):
+            shutil.rmtree(self.path(key))
+        os.replace(tmp_path, self.path(key))
+
+    def save(self, key:str, feats:np.ndarray, targets:np.ndarray, meta:dict=dict()):
+        tmp_path = self._tmp_path(key)
+        os.makedirs(tmp_path, exist_ok=True)
+        np.save(os.path.join(tmp_path, "feats.npy"), feats)
+        np.save(os.path.join(tmp_path, "targets.npy"), targets)
+        self._commit(key, dict(meta, n=len(feats), dim=int(feats.shape[1])))
+
+    def __repr__(self):
+        return f"EmbeddingStore(root={self.root}, entries={len(self.keys())})"
+
+def _batch_feats(model, x):
+    '''Features of a batch flattened to (batch, features), the first output is used if the model returns several'''
+    out = model(x)
+    if isinstance(out, (tuple, list)):
+        out = out[0]
+    return out.flatten(1)
+
+def extract_embeddings(model, dl, store:EmbeddingStore=None, key:str=None, device=None, dtype=np.float16, meta:dict=dict()):
+    '''Extract features of all items of a dataloader with a frozen model
+
+    Features of every batch are written into a preallocated memory-mapped file (´store´) or array,
+    targets are taken from the second element of every batch (-1 if there is none).
+    If ´key´ is already in ´store´, the cached features are returned without running the model.
+
+    Parameters
+    ----------
+    model : nn.Module
+        Backbone that returns features (e.g. the DINO backbone with identity head)
+
+    dl : DataLoader
+        Dataloader (without shuffling) of the dataset, batches are (imgs, targets, ...) or imgs
+
+    store, key : optional
+        Embedding store and key of the entry (e.g. ´f"{checkpoint}/{split}"´)
+
+    device : str; optional
+        Device to run the model on (defaults to the device of the model parameters)
+
+    dtype : np.dtype; optional
+        Dtype of the stored features
+
+    Returns
+    -------
+    feats, targets : np.ndarray
+    '''
+    if store is not None and key in store:
+        return store.load(key)[:2]
+
+    if device is None:
+        device = next(model.parameters()).device
+    n = len(dl.dataset)
+    feats, targets, pos = None, np.full(n, -1, dtype=np.int64), 0
+
+    training = model.training
+    model.eval()
+    with torch.inference_mode():
+        for batch in dl:
+            x, y = (batch[0], batch[1]) if isinstance(batch, (tuple, list)) else (batch, None)
+            f = _batch_feats(model, x.to(device)).float().cpu().numpy()
+            if feats is None:
+                if store is not None:
+                    os.makedirs(store._tmp_path(key), exist_ok=True)
+                    feats = np.lib.format.open_memmap(os.path.join(store._tmp_path(key), "feats.npy"), mode="w+",
+                                                       dtype=dtype, shape=(n, f.shape[1]))
+                else:
+                    feats = np.empty((n, f.shape[1]), dtype=dtype)
+            feats[pos:pos + len(f)] = f
+            if y is not None:
+                targets[pos:pos + len(f)] = np.asarray(y).ravel()
+            pos += len(f)
+    model.train(training)
+
+    if feats is None: # empty dataloader, hence the feature dimension is unknown
+        feats, targets = np.empty((0, 0), dtype=dtype), targets[:0]
+        if store is not None:
+            store.save(key, feats, targets, meta)
+            return store.load(key)[:2]
+        return feats, targets
+
+    if store is not None:
+        dim = feats.shape[1]
+        feats.flush()
+        del feats
+        np.save(os.path.join(store._tmp_path(key), "targets.npy"), targets)
+        store._commit(key, dict(meta, n=n, dim=dim))
+        return store.load(key)[:2]
+    return feats, targets
+
+# Cell
+def _as_float_tensor(feats, normalize):
+    feats = torch.as_tensor(np.asarray(feats, dtype=np.float32))
+    return F.normalize(feats, dim=1) if normalize else feats
+
+class KNNIndex():
+    '''Nearest neighbour index of features (cosine similarity if ´normalize´, inner product otherwise)
+
+    Exact search multiplies queries with blocks of ´block_size´ indexed features and merges the top k
+    of every block, hence memory is bounded by queries x ´block_size´ similarities. Features are kept
+    as given (e.g. memory-mapped float16) and converted to float32 block by block.
+    With ´approximate=True´ an HNSW graph of faiss (optional dependency) is searched instead.
+
+    Parameters
+    ----------
+    feats : np.ndarray
+        Features of shape (number of items, dim), e.g. memory-mapped from an ´EmbeddingStore´
+
+    targets : np.ndarray; optional
+        Labels of the indexed items (required by ´knn_accuracy´)
+
+    normalize : bool; optional
+        L2 normalize features and queries
+
+    block_size : int; optional
+        Number of indexed features that are compared to the queries at once
+
+    approximate : bool; optional
+        Use an approximate HNSW index of faiss
+    '''
+    def __init__(self, feats, targets=None, normalize:bool=True, block_size:int=16384, approximate:bool=False):
+        self.normalize = normalize
+        self.block_size = block_size
+        self.feats = feats
+        self.targets = None if targets is None else torch.as_tensor(np.asarray(targets), dtype=torch.int64)
+        self.faiss_index = None
+        if approximate:
+            try:
+                import faiss
+            except ImportError:
+                raise ImportError("Approximate search requires faiss (´pip install faiss-cpu´)")
+            self.faiss_index = faiss.IndexHNSWFlat(self.feats.shape[1], 32, faiss.METRIC_INNER_PRODUCT)
+            for start in range(0, len(self), self.block_size):
+                self.faiss_index.add(self._block(start).numpy())
+
+    def __len__(self):
+        return len(self.feats)
+
+    def _block(self, start):
+        return _as_float_tensor(self.feats[start:start + self.block_size], self.normalize)
+
+    def search(self, queries, k:int):
+        '''Similarities and indices of the ´k´ nearest neighbours of every query (sorted by similarity)'''
+        queries, k = _as_float_tensor(queries, self.normalize), min(k, len(self))
+        if self.faiss_index is not None:
+            sims, idxs = self.faiss_index.search(queries.numpy(), k)
+            return torch.from_numpy(sims), torch.from_numpy(idxs).long()
+
+        best_sims, best_idxs = None, None
+        for start in range(0, len(self), self.block_size):
+            sims = queries @ self._block(start).T
+            sims, idxs = sims.topk(min(k, sims.shape[1]), dim=1)
+            if best_sims is not None:
+                sims, idxs = torch.cat([best_sims, sims], dim=1), torch.cat([best_idxs, idxs + start], dim=1)
+                sims, order = sims.topk(min(k, sims.shape[1]), dim=1)
+                idxs = idxs.gather(1, order)
+            best_sims, best_idxs = sims, idxs
+        return best_sims, best_idxs
+
+def knn_accuracy(index:KNNIndex, feats, targets, ks:list=[10, 20, 100, 200], temperature:float=0.07,
+                 num_classes:int=None, query_block:int=1024):
+    '''Accuracy of the weighted kNN classifier (as in DINO) for several k from a single search
+
+    Neighbours vote for their class with weight exp(similarity / ´temperature´).
+
+    Parameters
+    ----------
+    index : KNNIndex
+        Index of the (train) features with targets
+
+    feats, targets : np.ndarray
+        Features and labels of the evaluated (test) items
+
+    ks : list; optional
+        Numbers of neighbours (the index is searched once for the largest one)
+
+    Returns
+    -------
+    accs : dict
+        Accuracy for every k
+    '''
+    targets = torch.as_tensor(np.asarray(targets), dtype=torch.int64)
+    if index.targets is None:
+        raise ValueError("´index´ has no targets")
+    if (index.targets < 0).any() or (targets < 0).any():
+        # e.g. -1 of ´extract_embeddings´ for batches without targets
+        raise ValueError("Targets of ´index´ and queries must be non-negative class indices")
+    if num_classes is None:
+        num_classes = int(max(index.targets.max(), targets.max())) + 1
+    k_max = min(max(ks), len(index))
+
+    correct = {k: 0 for k in ks}
+    for start in range(0, len(targets), query_block):
+        sims, idxs = index.search(feats[start:start + query_block], k_max)
+        weights, labels = (sims / temperature).exp(), index.targets[idxs]
+        for k in ks:
+            votes = torch.zeros(len(labels), num_classes).scatter_add_(1, labels[:, :k], weights[:, :k])
+            correct[k] += int((votes.argmax(dim=1) == targets[start:start + query_block]).sum())
+    return {k: correct[k] / len(targets) for k in ks}
+
+def linear_probe(train_feats, train_targets, test_feats, test_targets, normalize:bool=True, C:float=1.0, max_iter:int=1000):
+    '''Accuracy of a logistic regression trained on frozen features'''
+    train_feats, test_feats = [_as_float_tensor(feats, normalize).numpy() for feats in [train_feats, test_feats]]
+    clf = LogisticRegression(C=C, max_iter=max_iter).fit(train_feats, np.asarray(train_targets))
+    return float((clf.predict(test_feats) == np.asarray(test_targets)).mean())
\ No newline at end of file
@@ -1,13 +1,15 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: nb_inference.general.ipynb (unless otherwise specified).
 
-__all__ = ['convert_test_df', 'PredictionWriter']
+__all__ = ['convert_test_df', 'PredictionWriter', 'PredictionReader']
 
 # Cell
 import pandas as pd
 import numpy as np
 from pytorch_lightning.callbacks import BasePredictionWriter
 import torch
+from torch.utils.data import DataLoader
 import os
+import json
 from pathlib import Path
 
 # Cell
@@ -23,21 +25,158 @@ def convert_test_df(df):
 
 # Cell
 class PredictionWriter(BasePredictionWriter):
-    '''Blabla
+    '''Write predictions (tuples of probabilities and ground truth) of all predict dataloaders to disk
+
+    With ´write_interval="epoch"´ all predictions are gathered in memory and saved to a single
+    ´<output_file>.pt´ file at the end of the epoch.
+
+    With ´write_interval="batch"´ predictions are buffered per dataloader and flushed every
+    ´flush_every´ batches to numbered .npy shards in ´<output_dir>/<output_file>/<dataset_name>/´.
+    Every process writes its own shards and ´manifest_rank<global_rank>.json´ which records the completed
+    shards, i.e. with DDP the items are grouped by rank in the order of the distributed sampler. By default,
+    shards of previous runs are removed when a dataset is written. With ´resume=True´, the predict dataloaders
+    are restricted to the batches after the last completed shard before inference starts, i.e. the model only
+    runs on the remaining batches (this requires a deterministic sampler, which is the default for predict
+    dataloaders). The manifest has to belong to the same run (´run_id´, e.g. the checkpoint), dataset length
+    and number of processes, otherwise a ValueError is raised. Use ´trainer.predict(..., return_predictions=False)´
+    so that Lightning does not keep predictions in memory either, and ´PredictionReader´ to read the shards.
 
     Parameters
     ----------
+    output_dir : str
+        Directory in which predictions are saved
+
+    output_file : str
+        Name of the output file (epoch mode) or of the shard directory (batch mode)
+
+    dataset_names : list; optional
+        Names of the predict dataloaders. If empty, dataloader indices are used.
+
+    write_interval : str; optional
+        Either ´epoch´ or ´batch´
+
+    flush_every : int; optional
+        Number of batches per shard (only used with ´write_interval="batch"´)
 
-    splits : dict; optional
-        Contains
+    resume : bool; optional
+        Continue writing after the completed shards of an interrupted run (only used with ´write_interval="batch"´)
+
+    run_id : str; optional
+        Identifier of the run (e.g. checkpoint path) that is stored in the manifest and checked on resume
     '''
-    def __init__(self, output_dir:str, output_file:str, dataset_names=list(), write_interval="epoch"):
+    def __init__(self, output_dir:str, output_file:str, dataset_names=list(), write_interval="epoch", flush_every=100,
+                 resume:bool=False, run_id:str=None):
         super().__init__(write_interval)
         self.output_dir = output_dir
         self.output_file = output_file
         self.dataset_names = dataset_names
+        self.flush_every = flush_every
+        self.resume = resume
+        self.run_id = run_id
         Path(self.output_dir).mkdir(parents=True, exist_ok=True)
 
+        self._buffers = dict()
+        self._manifests = dict()
+        self._batch_offsets = dict()
+        self._rank = 0
+
+    def _dataset_name(self, dataloader_idx):
+        if dataloader_idx < len(self.dataset_names):
+            return str(self.dataset_names[dataloader_idx])
+        return str(dataloader_idx)
+
+    def _shard_dir(self, dataset_name):
+        return os.path.join(self.output_dir, self.output_file, dataset_name)
+
+    def _manifest(self, dataset_name):
+        return self._manifests[dataset_name]
+
+    def _init_manifest(self, dataset_name, n_items, world_size):
+        '''Manifest of the current run, either resumed (after validation) or fresh with old shards of this rank removed'''
+        shard_dir = self._shard_dir(dataset_name)
+        manifest = _read_manifest(shard_dir, self._rank)
+        if self.resume and len(manifest["shards"]) > 0:
+            for key, value in [("run_id", self.run_id), ("n_items", n_items), ("world_size", world_size)]:
+                if manifest.get(key) != value:
+                    raise ValueError(f"Cannot resume {shard_dir}: manifest has {key}={manifest.get(key)}, current run has {key}={value}")
+            return manifest
+        # other ranks write into the same directory, so only files of this rank are removed
+        for f in Path(shard_dir).glob(f"*rank{self._rank}[._]*"):
+            f.unlink()
+        return {"run_id": self.run_id, "n_items": n_items, "world_size": world_size, "rank": self._rank, "shards": list()}
+
+    def on_predict_start(self, trainer, pl_module):
+        # manifests and buffers only belong to a single run, i.e. the writer can be reused
+        self._buffers = dict()
+        self._manifests = dict()
+        self._batch_offsets = dict()
+        self._rank = trainer.global_rank
+        if not self.interval.on_batch:
+            return
+
+        dataloaders = trainer.predict_dataloaders or list()
+        for dataloader_idx, dataloader in enumerate(dataloaders):
+            dataset_name = self._dataset_name(dataloader_idx)
+            manifest = self._init_manifest(dataset_name, _num_items(dataloader), trainer.world_size)
+            self._manifests[dataset_name] = manifest
+            if len(manifest["shards"]) == 0:
+                continue
+
+            # skip the completed batches before the model runs on them
+            n_done = manifest["shards"][-1]["last_batch"] + 1
+            dataloader = _skip_batches(dataloader, n_done)
+            if dataloader is not None:
+                trainer.predict_dataloaders[dataloader_idx] = dataloader
+                trainer.num_predict_batches[dataloader_idx] = min(trainer.num_predict_batches[dataloader_idx], len(dataloader))
+                self._batch_offsets[dataset_name] = n_done
+
+    def write_on_batch_end(self, trainer, pl_module, prediction, batch_indices, batch, batch_idx, dataloader_idx):
+        dataset_name = self._dataset_name(dataloader_idx)
+        manifest = self._manifest(dataset_name)
+        batch_idx = batch_idx + self._batch_offsets.get(dataset_name, 0)
+
+        # batch is already part of a completed shard (resumed run of a dataloader whose batches cannot be skipped)
+        if len(manifest["shards"]) > 0 and batch_idx <= manifest["shards"][-1]["last_batch"]:
+            return
+
+        probs, gts = prediction
+        buffer = self._buffers.setdefault(dataset_name, {"first_batch": batch_idx, "probs": list(), "gts": list()})
+        buffer["probs"].append(probs.detach().cpu().numpy())
+        buffer["gts"].append(gts.detach().cpu().numpy())
+        buffer["last_batch"] = batch_idx
+
+        if len(buffer["probs"]) >= self.flush_every:
+            self._flush(dataset_name)
+
+    def _flush(self, dataset_name):
+        buffer = self._buffers.pop(dataset_name, None)
+        if buffer is None or len(buffer["probs"]) == 0:
+            return
+
+        shard_dir = self._shard_dir(dataset_name)
+        Path(shard_dir).mkdir(parents=True, exist_ok=True)
+        manifest = self._manifest(dataset_name)
+        shard_name = f"rank{self._rank}_shard_{len(manifest['shards']):05d}"
+
+        # write arrays first and register the shard afterwards so that an interrupted write is never used
+        for key in ["probs", "gts"]:
+            tmp_file = os.path.join(shard_dir, f"{shard_name}_{key}.tmp.npy")
+            np.save(tmp_file, np.concatenate(buffer[key], axis=0))
+            os.replace(tmp_file, os.path.join(shard_dir, f"{shard_name}_{key}.npy"))
+
+        manifest["shards"].append({
+            "name": shard_name,
+            "n": int(sum(len(v) for v in buffer["gts"])),
+            "first_batch": buffer["first_batch"],
+            "last_batch": buffer["last_batch"],
+        })
+        _write_manifest(shard_dir, manifest, self._rank)
+
+    def on_predict_epoch_end(self, trainer, pl_module, *args, **kwargs):
+        for dataset_name in list(self._buffers.keys()):
+            self._flush(dataset_name)
+        super().on_predict_epoch_end(trainer, pl_module, *args, **kwargs)
+
     def write_on_epoch_end(self, trainer, pl_module, predictions, batch_indices):
 
         dataset_names = self.dataset_names
@@ -50,4 +189,87 @@ class PredictionWriter(BasePredictionWriter):
             probs, gts = torch.concat(probs, dim=0), torch.concat(gts, dim=0)
             preds[dataset_name] = (probs, gts)
 
-        torch.save(preds, os.path.join(self.output_dir, f"{self.output_file}.pt"))
\ No newline at end of file
+        torch.save(preds, os.path.join(self.output_dir, f"{self.output_file}.pt"))
+
+def _num_items(dataloader):
+    '''Length of the dataset of a predict dataloader (None if unknown)'''
+    try:
+        return len(dataloader.dataset)
+    except (AttributeError, TypeError):
+        return None
+
+def _skip_batches(dataloader, n):
+    '''Copy of ´dataloader´ without its first ´n´ batches (None if its batches are not indexable, e.g. iterable datasets)'''
+    if getattr(dataloader, "batch_sampler", None) is None:
+        return None
+    batches = list(dataloader.batch_sampler)[n:]
+    kwargs = dict()
+    if dataloader.num_workers > 0:
+        kwargs = dict(prefetch_factor=dataloader.prefetch_factor, persistent_workers=dataloader.persistent_workers)
+    return DataLoader(dataloader.dataset, batch_sampler=batches, num_workers=dataloader.num_workers,
+                      collate_fn=dataloader.collate_fn, pin_memory=dataloader.pin_memory, timeout=dataloader.timeout,
+                      worker_init_fn=dataloader.worker_init_fn, multiprocessing_context=dataloader.multiprocessing_context,
+                      generator=dataloader.generator, **kwargs)
+
+def _manifest_file(shard_dir, rank):
+    return os.path.join(shard_dir, f"manifest_rank{rank}.json")
+
+def _read_manifest(shard_dir, rank):
+    manifest_file = _manifest_file(shard_dir, rank)
+    if not os.path.exists(manifest_file):
+        return {"shards": list()}
+    with open(manifest_file) as f:
+        return json.load(f)
+
+def _write_manifest(shard_dir, manifest, rank):
+    tmp_file = f"{_manifest_file(shard_dir, rank)}.tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_file, _manifest_file(shard_dir, rank))
+
+# Cell
+class PredictionReader():
+    '''Read predictions written by ´PredictionWriter´ with ´write_interval="batch"´
+
+    Shards are memory-mapped and only reassembled into tensors when a dataset is accessed. Shards written by
+    several processes (DDP) are read in the order of their ranks.
+
+    Parameters
+    ----------
+    output_dir : str
+        Same as for ´PredictionWriter´
+
+    output_file : str
+        Same as for ´PredictionWriter´
+    '''
+    def __init__(self, output_dir:str, output_file:str):
+        self.root = os.path.join(output_dir, output_file)
+        self.dataset_names = sorted(d for d in os.listdir(self.root) if os.path.isdir(os.path.join(self.root, d)))
+
+    def iter_shards(self, dataset_name):
+        '''Iterate over (probs, gts) numpy arrays of every completed shard without loading all of them'''
+        shard_dir = os.path.join(self.root, str(dataset_name))
+        # the world size of rank 0 excludes left-over manifests of previous runs with more processes
+        world_size = _read_manifest(shard_dir, 0).get("world_size", 1)
+        for rank in range(world_size):
+            for shard in _read_manifest(shard_dir, rank)["shards"]:
+                yield tuple(np.load(os.path.join(shard_dir, f"{shard['name']}_{key}.npy"), mmap_mode="r") for key in ["probs", "gts"])
+
+    def __len__(self):
+        return len(self.dataset_names)
+
+    def __getitem__(self, dataset_name):
+        '''Fastai-style-like prediction (probs, gts) of a dataset'''
+        shards = list(self.iter_shards(dataset_name))
+        if len(shards) == 0:
+            raise KeyError(f"No completed shards of dataset '{dataset_name}' in {self.root}")
+        probs, gts = zip(*shards)
+        return torch.from_numpy(np.concatenate(probs, axis=0)), torch.from_numpy(np.concatenate(gts, axis=0))
+
+    def items(self):
+        for dataset_name in self.dataset_names:
+            yield dataset_name, self[dataset_name]
+
+    def to_dict(self):
+        '''Same structure as the file saved by ´PredictionWriter´ with ´write_interval="epoch"´'''
+        return dict(self.items())
\ No newline at end of file
@@ -1,11 +1,13 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: nb_projects.robustness_benchmark.ipynb (unless otherwise specified).
 
 __all__ = ['BenchmarkBaseline', 'Corruption', 'Perturbation', 'max_severity', 'num_frames', 'classes', 'bal_error_rate',
-           'error_rate', 'auroc', 'acc', 'spec', 'sens', 'bal_acc', 'flip_rate', 'flip_prob', 'relative_perf',
-           'adjust_by_baseline', 'score_sam', 'score_samc', 'score_samp', 'save_perf']
+           'error_rate', 'auroc', 'acc', 'spec', 'sens', 'bal_acc', 'flip_counts', 'flip_rate', 'flip_prob',
+           'relative_perf', 'adjust_by_baseline', 'add_path_metadata', 'score_sam', 'score_samc', 'score_samp',
+           'binary_metrics', 'save_perf', 'BenchmarkRunner']
 
 # Cell
 import os
+import re
 import torch
 import pandas as pd
 import numpy as np
@@ -13,7 +15,7 @@ import numpy as np
 from enum import Enum
 from collections import Counter
 from functools import partial
-from ..analysis.binary import performance
+from ..analysis.binary import performance, BinaryMetrics
 from ..utils.dict import apply_to_vals, flatten_intra
 
 # Cell
@@ -90,85 +92,62 @@ class BenchmarkBaseline():
 # Cell
 # get balanced error rate
 def bal_error_rate(v):
-    perf = performance(v[1], v[0][:,1], bal_err_rate=True)
-    return perf["bal_err_rate"]
+    return BinaryMetrics.from_preds(v)["bal_err_rate"]
 
 # get normal error rate
 def error_rate(v):
-    perf = performance(v[1], v[0][:,1], err_rate=True)
-    return perf["err_rate"]
+    return BinaryMetrics.from_preds(v)["err_rate"]
 
 # get auroc
 def auroc(v):
-    perf = performance(v[1], v[0][:,1], auroc=True)
-    return perf["auroc"]
+    return BinaryMetrics.from_preds(v)["auroc"]
 
 # get acc
 def acc(v):
-    perf = performance(v[1], v[0][:,1])
-    return perf["acc"]
+    return BinaryMetrics.from_preds(v)["acc"]
 
 # get spec
 def spec(v):
-    perf = performance(v[1], v[0][:,1])
-    return perf["sens"]
+    return BinaryMetrics.from_preds(v)["sens"]
 
 # get sens
 def sens(v):
-    perf = performance(v[1], v[0][:,1])
-    return perf["spec"]
+    return BinaryMetrics.from_preds(v)["spec"]
 
 # get sens
 def bal_acc(v):
-    perf = performance(v[1], v[0][:,1], bal_acc=True)
-    return perf["bal_acc"]
+    return BinaryMetrics.from_preds(v)["bal_acc"]
 
-def flip_rate(k, v, n):
-    preds = v[0]
+def flip_counts(k, v, n):
+    '''Number of prediction flips for every image sequence (which contains 'n' number of frames)
+
+    For noise sequences every frame is compared to the first frame, otherwise consecutive frames
+    are compared. Returns an integer array of shape (number of sequences,).
+    '''
+    preds = torch.as_tensor(v[0])
     stop = preds.shape[0]
     assert stop%n == 0, f"Number of predictions ({stop}) is not evenly divisible by stepsize ({n})!"
 
-    noise_seq = False
-    if "noise" in k:
-        noise_seq = True
+    # one row per image sequence
+    seq_preds = preds.argmax(dim=1).reshape(-1, n)
 
-    # calculate flip rate for a single image sequence (which contains 'n' number of frames)
-    n_sum, m = 0, 0
-    for i in range(0, stop, n):
-        m += 1
-        seq_preds = preds[i:i+n].argmax(dim=1)
+    if "noise" in k:
+        flips = seq_preds[:, 1:] != seq_preds[:, :1]
+    else:
+        flips = seq_preds[:, 1:] != seq_preds[:, :-1]
 
-        if noise_seq:
-            n_sum += sum(seq_preds[0]!=seq_preds[1:])
-        else:
-            n_sum += sum(seq_preds[:-1]!=seq_preds[1:])
+    return flips.sum(dim=1).cpu().numpy()
 
-    return (n_sum/(m*(n-1))).item()
+def flip_rate(k, v, n):
+    counts = flip_counts(k, v, n)
+    return (counts.sum()/(len(counts)*(n-1))).item()
 
 # Cell
 
 # get flib probability
 def flip_prob(k, v, n):
-    preds = v[0]
-    stop = preds.shape[0]
-    assert stop%n == 0, f"Number of predictions ({stop}) is not evenly divisible by stepsize ({n})!"
-
-    noise_seq = False
-    if "noise" in k:
-        noise_seq = True
-
-    # calculate flip rate for a single image sequence (which contains 'n' number of frames)
-    n_sum, m = 0, 0
-    for i in range(0, stop, n):
-        m += 1
-        seq_preds = preds[i:i+n].argmax(dim=1)
-
-        if noise_seq:
-            n_sum += sum(seq_preds[0]!=seq_preds[1:])
-        else:
-            n_sum += sum(seq_preds[:-1]!=seq_preds[1:])
-
-    return (n_sum/(m*(n-1))).item()
+    counts = flip_counts(k, v, n)
+    return (counts.sum()/(len(counts)*(n-1))).item()
 
 def relative_perf(perf_c:dict, perf_cl:float):
 
@@ -186,6 +165,33 @@ def adjust_by_baseline(perf:dict, base:dict):
     return perf
 
 # Cell
+def add_path_metadata(df:pd.DataFrame, severities:bool=True):
+    '''Add transformation type (and severity) parsed from "image_path" as categorical columns
+
+    The caller's dataframe is not modified and columns which already exist are not parsed again,
+    hence the parsing cost is only paid once if the returned dataframe is reused.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        dataframe with column "image_path" of the form ".../.../<tfms>/<severities>/..."
+
+    severities : bool; optional
+        Whether to also parse the severity level (only needed for corruptions)
+
+    Returns
+    -------
+    df : pd.DataFrame
+        dataframe with columns "tfms" (and "severities")
+    '''
+    cols = {"tfms": 2, "severities": 3} if severities else {"tfms": 2}
+    missing = {col: pos for col, pos in cols.items() if col not in df.columns}
+    if len(missing) == 0:
+        return df
+
+    parts = df["image_path"].str.split("/", expand=True)
+    return df.assign(**{col: parts[pos].astype("category") for col, pos in missing.items()})
+
 def score_sam(df:pd.DataFrame, eval_func):
     '''Compute performance score for SAM using 'eval_func'
 
@@ -195,14 +201,20 @@ def score_sam(df:pd.DataFrame, eval_func):
         dataframe with columns "nevus" and "melanoma" which contain probability scores
         and column "ground_truth" which contains a 0 (nevus) or 1 (melanoma)
 
-    eval_func : callable
-        function which is used to evaluate the predictions
+    eval_func : callable or list
+        function which is used to evaluate the predictions or a list of metric names of ´BinaryMetrics´
+        (all metrics are computed from one ´BinaryMetrics´ per prediction)
 
     Returns
     -------
     perf : dict
-        Stores performance score
+        Stores performance score (one performance dict per metric if ´eval_func´ is a list)
     '''
+    metrics = _metric_names(eval_func)
+    if metrics is not None:
+        perf = score_sam(df, partial(binary_metrics, metrics=metrics))
+        return {metric: apply_to_vals(perf, lambda v: v[metric]) for metric in metrics}
+
     perf = dict()
     preds = (torch.Tensor(np.array(df[["nevus", "melanoma"]])), torch.LongTensor(np.array(df["ground_truth"])))
     perf["clean"] = eval_func(preds)
@@ -218,23 +230,25 @@ def score_samc(df:pd.DataFrame, eval_func):
         dataframe with columns "nevus" and "melanoma" which contain probability scores
         and column "ground_truth" which contains a 0 (nevus) or 1 (melanoma)
 
-    eval_func : callable
-        function which is used to evaluate the predictions
+    eval_func : callable or list
+        function which is used to evaluate the predictions or a list of metric names of ´BinaryMetrics´
+        (all metrics are computed from one ´BinaryMetrics´ per prediction)
 
     Returns
     -------
     perf : dict
-        Stores performance score
+        Stores performance score (one performance dict per metric if ´eval_func´ is a list)
     '''
-    # add transformation type to df (required for scoring corruptions and perturbations)
-    df["tfms"] = df.image_path.apply(lambda x: x.split("/")[2])
-
-    # add severity levels to df (only needed for corruptions)
-    df["severities"] = df.image_path.apply(lambda x: x.split("/")[3])
+    # add transformation type and severity levels (required for scoring corruptions)
+    df = add_path_metadata(df)
     assert df["severities"].nunique()==5, f"Invalid number of severities ({df['severities'].nunique()})"
 
+    metrics = _metric_names(eval_func)
+    if metrics is not None:
+        eval_func = partial(binary_metrics, metrics=metrics)
+
     perf = dict()
-    for (k1, k2), group_df in df.groupby(["tfms", "severities"]):
+    for (k1, k2), group_df in df.groupby(["tfms", "severities"], observed=True):
         preds = (torch.Tensor(np.array(group_df[["nevus", "melanoma"]])), torch.LongTensor(np.array(group_df["ground_truth"])))
 
         if perf.get(k1):
@@ -243,6 +257,9 @@ def score_samc(df:pd.DataFrame, eval_func):
             perf[k1] = dict()
             perf[k1][k2] = eval_func(preds)
 
+    if metrics is not None:
+        return {metric: apply_to_vals(flatten_intra(apply_to_vals(perf, lambda v: v[metric])), np.mean) for metric in metrics}
+
     perf = apply_to_vals(flatten_intra(perf), np.mean)
 
     return perf
@@ -256,26 +273,207 @@ def score_samp(df:pd.DataFrame, eval_func):
         dataframe with columns "nevus" and "melanoma" which contain probability scores
         and column "ground_truth" which contains a 0 (nevus) or 1 (melanoma)
 
-    eval_func : callable
-        function which is used to evaluate the predictions
+    eval_func : callable or list
+        function which is used to evaluate the predictions or a list of metric names of ´BinaryMetrics´
+        (all metrics are computed from one ´BinaryMetrics´ per prediction)
 
     Returns
     -------
     perf : dict
-        Stores performance score
+        Stores performance score (one performance dict per metric if ´eval_func´ is a list)
     '''
-    # add transformation type to df (required for scoring corruptions and perturbations)
-    df["tfms"] = df.image_path.apply(lambda x: x.split("/")[2])
+    # add transformation type (required for scoring perturbations)
+    df = add_path_metadata(df, severities=False)
 
+    metrics = _metric_names(eval_func)
     perf = dict()
 
-    for k1, group_df in df.groupby(["tfms"]):
+    for k1, group_df in df.groupby("tfms", observed=True):
         preds = (torch.Tensor(np.array(group_df[["nevus", "melanoma"]])), torch.LongTensor(np.array(group_df["ground_truth"])))
-        perf[k1] = eval_func(k1, preds)
+        perf[k1] = eval_func(k1, preds) if metrics is None else binary_metrics(preds, metrics)
+
+    if metrics is not None:
+        return {metric: apply_to_vals(perf, lambda v: v[metric]) for metric in metrics}
 
     return perf
 
+def binary_metrics(preds, metrics:list):
+    '''Series with several metrics of ´BinaryMetrics´ which are computed from a single bundle'''
+    return pd.Series(BinaryMetrics.from_preds(preds).compute(*metrics))
+
+def _metric_names(eval_func):
+    '''Metric names if ´eval_func´ is a list of ´BinaryMetrics´ metrics, otherwise None'''
+    if not isinstance(eval_func, (list, tuple)):
+        return None
+    unknown = set(eval_func) - set(BinaryMetrics.metric_names)
+    if len(unknown) > 0:
+        raise ValueError(f"Unknown metrics {sorted(unknown)}")
+    return list(eval_func)
+
 def save_perf(df:pd.DataFrame, out_path:str, out_file:str):
     if not os.path.exists(out_path):
         os.mkdir(out_path)
-    df.to_csv(f"{out_path}/{out_file}.csv", index=False)
\ No newline at end of file
+    df.to_csv(f"{out_path}/{out_file}.csv", index=False)
+
+# Cell
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+
+def _eval_group(eval_func, tfm, probs, gt, pass_key):
+    preds = (torch.Tensor(probs), torch.LongTensor(gt))
+    return eval_func(tfm, preds) if pass_key else eval_func(preds)
+
+def _func_name(func):
+    '''Identity of ´func´ (qualified name and all arguments of partials) which is used as cache key'''
+    if isinstance(func, partial):
+        args = [repr(arg) for arg in func.args] + [f"{k}={v!r}" for k, v in func.keywords.items()]
+        return "_".join([_func_name(func.func)] + args)
+    name = getattr(func, "__qualname__", "<unnamed>")
+    if "<" in name: # lambdas, local functions and callable objects cannot be identified
+        raise ValueError(f"Cannot derive a cache key for {func!r}, pass ´eval_name´")
+    return f"{func.__module__}.{name}"
+
+class BenchmarkRunner():
+    '''Parallel and incremental scoring of SAM, SAM-C and SAM-P predictions
+
+    Predictions are split into (transformation, severity) groups which are evaluated in a process pool.
+    Scores are cached on disk per model and evaluation function together with a fingerprint of the
+    evaluation function (including the arguments of partials) and the group's predictions. Groups that were already scored with identical predictions are read from
+    the cache, hence adding a new model or a new corruption only scores the delta.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Directory in which scores are cached (one csv file per model and evaluation function)
+
+    num_workers : int; optional
+        Number of processes used to evaluate groups. If 1, groups are evaluated in the main process.
+    '''
+    group_cols = {"sam": [], "samc": ["tfms", "severities"], "samp": ["tfms"]}
+
+    def __init__(self, cache_dir:str, num_workers:int=1):
+        self.cache_dir = cache_dir
+        self.num_workers = num_workers
+
+    def _cache_file(self, model_name, eval_name):
+        return os.path.join(self.cache_dir, model_name, f"{eval_name}.csv")
+
+    def _load_cache(self, cache_file):
+        if not os.path.exists(cache_file):
+            return dict()
+        cache_df = pd.read_csv(cache_file, dtype={"tfms": str, "severities": str, "fingerprint": str}, keep_default_na=False)
+        return {(row.tfms, row.severities): (row.fingerprint, row.score) for row in cache_df.itertuples()}
+
+    def _save_cache(self, cache_file, cache):
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        cache_df = pd.DataFrame([(k1, k2, fp, score) for (k1, k2), (fp, score) in cache.items()],
+                                columns=["tfms", "severities", "fingerprint", "score"])
+        cache_df.to_csv(cache_file, index=False)
+
+    def _eval_names(self, eval_func, eval_name):
+        '''Map cache names to the identities of the evaluation function(s) which are part of the fingerprint'''
+        metrics = _metric_names(eval_func)
+        if metrics is not None:
+            return {metric: f"BinaryMetrics.{metric}" for metric in metrics}
+        if eval_name is None:
+            identity = _func_name(eval_func)
+            return {re.sub(r"[^\w.=,-]", "_", identity): identity}
+        try:
+            return {eval_name: _func_name(eval_func)}
+        except ValueError:
+            return {eval_name: eval_name}
+
+    def score(self, model_name:str, df:pd.DataFrame, eval_func, benchmark:str="samc", eval_name:str=None):
+        '''Compute performance score of a single model using 'eval_func'
+
+        Parameters
+        ----------
+        model_name : str
+            Name under which the scores of this model are cached
+
+        df : pd.DataFrame
+            dataframe with columns "nevus" and "melanoma" which contain probability scores,
+            column "ground_truth" which contains a 0 (nevus) or 1 (melanoma) and column "image_path"
+
+        eval_func : callable or list
+            function which is used to evaluate the predictions. For SAM-P it is called with the
+            transformation type as first argument (e.g. ´partial(flip_prob, n=num_frames)´).
+            Alternatively a list of metric names of ´BinaryMetrics´ which are computed from one
+            ´BinaryMetrics´ per group and cached separately.
+
+        benchmark : str; optional
+            One of "sam", "samc" (also used for SAM-C-Extra) or "samp" (also used for SAM-P-Extra)
+
+        eval_name : str; optional
+            Name of the evaluation function in the cache. Derived from ´eval_func´ if None, which
+            is not possible for lambdas and local functions. For these, ´eval_name´ alone identifies
+            the function, i.e. it has to be changed when the function changes. Ignored for a list of metrics.
+
+        Returns
+        -------
+        perf : dict
+            Stores performance score (same as ´score_sam´, ´score_samc´ and ´score_samp´)
+        '''
+        if benchmark not in self.group_cols:
+            raise ValueError(f"Unknown benchmark {benchmark}")
+        group_cols = self.group_cols[benchmark]
+        if benchmark != "sam":
+            df = add_path_metadata(df, severities=benchmark=="samc")
+        if benchmark == "samc":
+            assert df["severities"].nunique()==5, f"Invalid number of severities ({df['severities'].nunique()})"
+
+        metrics = _metric_names(eval_func)
+        eval_names = self._eval_names(eval_func, eval_name)
+        cache_files = {name: self._cache_file(model_name, name) for name in eval_names}
+        caches = {name: self._load_cache(cache_file) for name, cache_file in cache_files.items()}
+
+        # split predictions into groups and find groups which are not cached (or have changed)
+        groups = [(("clean",), df)] if len(group_cols)==0 else df.groupby(group_cols, observed=True)
+        keys, fingerprints, todo = list(), dict(), list()
+        for k, group_df in groups:
+            k = tuple(map(str, k)) if isinstance(k, tuple) else (str(k),)
+            key = k if len(k)==2 else (k[0], "")
+            probs = np.ascontiguousarray(group_df[classes].to_numpy(dtype=np.float32))
+            gt = np.ascontiguousarray(group_df["ground_truth"].to_numpy(dtype=np.int64))
+            data = probs.tobytes() + gt.tobytes()
+            fingerprints[key] = {name: hashlib.sha1(identity.encode() + data).hexdigest() for name, identity in eval_names.items()}
+            keys.append(key)
+            if any(caches[name].get(key, (None,))[0] != fp for name, fp in fingerprints[key].items()):
+                todo.append((key, probs, gt))
+
+        # evaluate missing groups (all metrics of a list from one ´BinaryMetrics´ per group)
+        if len(todo) > 0:
+            func = eval_func if metrics is None else partial(binary_metrics, metrics=metrics)
+            args = ([func]*len(todo), [key[0] for key, _, _ in todo], [probs for _, probs, _ in todo],
+                    [gt for _, _, gt in todo], [benchmark=="samp" and metrics is None]*len(todo))
+            if self.num_workers > 1:
+                with ProcessPoolExecutor(max_workers=self.num_workers) as pool:
+                    scores = list(pool.map(_eval_group, *args))
+            else:
+                scores = list(map(_eval_group, *args))
+            for (key, _, _), score in zip(todo, scores):
+                for name in eval_names:
+                    caches[name][key] = (fingerprints[key][name], score if metrics is None else score[name])
+            for name, cache_file in cache_files.items():
+                self._save_cache(cache_file, caches[name])
+
+        # aggregate like score_sam/score_samc/score_samp
+        perfs = dict()
+        for name in eval_names:
+            perf = dict()
+            for k1, k2 in keys:
+                perf.setdefault(k1, list()).append(caches[name][(k1, k2)][1])
+            perfs[name] = apply_to_vals(perf, np.mean)
+        return perfs if metrics is not None else perfs[next(iter(eval_names))]
+
+    def score_all(self, dfs:dict, eval_func, benchmark:str="samc", eval_name:str=None):
+        '''Score several models, ´dfs´ maps model names to prediction dataframes.
+
+        Returns a dataframe with one row per model and one column per transformation type
+        (and one column level per metric if ´eval_func´ is a list of metric names).
+        '''
+        perfs = {model_name: self.score(model_name, df, eval_func, benchmark, eval_name) for model_name, df in dfs.items()}
+        if _metric_names(eval_func) is not None:
+            perfs = {model_name: {(metric, tfm): v for metric, perf_m in perf.items() for tfm, v in perf_m.items()}
+                     for model_name, perf in perfs.items()}
+        return pd.DataFrame.from_dict(perfs, orient="index")
\ No newline at end of file
@@ -1,65 +1,115 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: nb_train.balance.ipynb (unless otherwise specified).
 
-__all__ = ['downsample_df', 'upsample_df', 'balance_df']
+__all__ = ['sample_class_idxs', 'group_by_class', 'balance_idxs', 'downsample_df', 'upsample_df', 'balance_df']
 
 # Cell
 import pandas as pd
 import numpy as np
 
 # Cell
-def downsample_df(df:pd.DataFrame, y_column:str, min_size:int=None, random_state:int=115, **kwargs) -> pd.DataFrame:
+def sample_class_idxs(order:np.ndarray, counts:np.ndarray, sizes:np.ndarray, rng) -> np.ndarray:
+    '''Sample row positions such that every class has the requested size.
+
+    "order" contains all row positions sorted by class, "counts" and "sizes" contain the current and
+    requested size of every class. Classes larger than their requested size are sampled without replacement
+    and the positions that are kept remain in their original order. Classes smaller than their requested size
+    keep all positions and are completed by sampling with replacement, these positions are appended class by class.
+    '''
+    starts = np.cumsum(counts) - counts
+    cls = np.repeat(np.arange(len(counts)), counts) # class of every position in "order"
+
+    # random permutation within every class (classes stay in contiguous blocks as "cls" is sorted)
+    perm = np.lexsort((rng.random(len(order)), cls))
+    rank = np.arange(len(order)) - starts[cls]
+    keep = order[perm[rank < np.minimum(sizes, counts)[cls]]]
+
+    # additional samples (with replacement) for classes that are too small
+    n_extra = np.maximum(sizes - counts, 0)
+    extra_cls = np.repeat(np.arange(len(counts)), n_extra)
+    extra = order[starts[extra_cls] + (rng.random(len(extra_cls)) * counts[extra_cls]).astype(np.int64)]
+
+    return np.concatenate([np.sort(keep), extra])
+
+def group_by_class(y):
+    '''Get row positions sorted by class ("order") and the number of rows per class ("counts").
+
+    Classes are sorted by label. Rows with a missing label form an additional last class.
+    '''
+    codes, uniques = pd.factorize(np.asarray(y), sort=True)
+    codes = np.where(codes < 0, len(uniques), codes)
+    counts = np.bincount(codes, minlength=len(uniques)+1)
+    order = np.argsort(codes, kind="stable")
+    return order, counts
+
+def _check_no_kwargs(func_name, kwargs):
+    '''Sampling is no longer done with ´DataFrame.sample´, hence its arguments cannot be passed on anymore'''
+    if len(kwargs) > 0:
+        raise TypeError(f"{func_name}() does not support the arguments {list(kwargs)} anymore")
+
+def balance_idxs(y, lower:int=None, upper:int=None, random_state:int=115) -> np.ndarray:
+    '''Row positions which balance the classes in "y" by clipping the size of every class to ["lower", "upper"].
+
+    All classes are sampled in one vectorized pass (see ´sample_class_idxs´). Rows with a missing label are
+    always kept. "random_state" can be an int or a ´np.random.Generator´.
+    '''
+    order, counts = group_by_class(y)
+    n_classes = len(counts) - 1 # missing labels are never resampled
+
+    sizes = counts.copy()
+    if lower is not None:
+        sizes[:n_classes] = np.maximum(sizes[:n_classes], lower)
+    if upper is not None:
+        sizes[:n_classes] = np.minimum(sizes[:n_classes], upper)
+
+    return sample_class_idxs(order, counts, sizes, np.random.default_rng(random_state))
+
+# Cell
+def downsample_df(df:pd.DataFrame, y_column:str, min_size:int=None, random_state:int=115, return_idxs:bool=False, **kwargs) -> pd.DataFrame:
     '''Balance classes of the target variable by downsampling all classes to be equal to or smaller than "min_size".
 
     Classes smaller than "min_size" are not affected and will remain at their current size. If "min_size" is ommitted,
     the size of the smallest current class is taken as "min_size".
     '''
-    df_new = df.copy()#.reset_index(drop=True)
-
+    _check_no_kwargs("downsample_df", kwargs)
     # get smallest current class if not supplied
-    if min_size == None:
-        min_size = df_new[y_column].value_counts().min()
+    if min_size is None:
+        min_size = df[y_column].value_counts().min()
 
     # downsample all classes larger than min_size
-    for class_index, group in df_new.groupby(y_column):
-        if group.shape[0] > min_size:
-            drop_idx = group.sample(len(group)-min_size, random_state=random_state, **kwargs).index
-            df_new = df_new.drop(drop_idx)
+    idxs = balance_idxs(df[y_column], upper=min_size, random_state=random_state)
+    if return_idxs:
+        return idxs
 
-    return df_new.reset_index(drop=True)
+    return df.take(idxs).reset_index(drop=True)
 
 # Cell
 
-def upsample_df(df:pd.DataFrame, y_column:str, max_size:int=None, random_state:int=115, **kwargs) -> pd.DataFrame:
+def upsample_df(df:pd.DataFrame, y_column:str, max_size:int=None, random_state:int=115, return_idxs:bool=False, **kwargs) -> pd.DataFrame:
     '''Balance classes of the target variable by upsampling all classes to be equal to or larger than "max_size".
 
     Classes larger than "max_size" are not affected and will remain at their current size. If "max_size" is ommitted,
     the size of the largest class is taken as "max_size".
     '''
-    df_new = df.copy()#.reset_index(drop=True)
-
+    _check_no_kwargs("upsample_df", kwargs)
     # get largest current class if not supplied
-    if max_size == None:
-        max_size = df_new[y_column].value_counts().max()
+    if max_size is None:
+        max_size = df[y_column].value_counts().max()
 
     # upsample all classes smaller than max_size
-    for class_index, group in df_new.groupby(y_column):
-        if group.shape[0] < max_size:
-            df_new = df_new.append(group.sample(max_size-len(group), replace=True, random_state=random_state, **kwargs))
+    idxs = balance_idxs(df[y_column], lower=max_size, random_state=random_state)
+    if return_idxs:
+        return idxs
 
-    return df_new.reset_index(drop=True)
+    return df.take(idxs).reset_index(drop=True)
 
 # Cell
 
-def balance_df(df:pd.DataFrame, y_column:str, size:int, random_state:int=115, **kwargs) -> pd.DataFrame:
+def balance_df(df:pd.DataFrame, y_column:str, size:int, random_state:int=115, return_idxs:bool=False, **kwargs) -> pd.DataFrame:
     '''Balance classes of the target variable by up- or downsampling all classes to be equal to "size".
     '''
-    df_new = df.copy().reset_index(drop=True)
-
-    for class_index, group in df_new.groupby(y_column):
-        if group.shape[0] < size:
-            df_new = df_new.append(group.sample(size-len(group), replace=True, random_state=random_state, **kwargs))
-        if group.shape[0] > size:
-            drop_idx = group.sample(len(group)-size, random_state=random_state, **kwargs).index
-            df_new = df_new.drop(drop_idx)
+    _check_no_kwargs("balance_df", kwargs)
+    idxs = balance_idxs(df[y_column], lower=size, upper=size, random_state=random_state)
+    if return_idxs:
+        return idxs
 
-    return df_new.reset_index(drop=True)
\ No newline at end of file
+    return df.take(idxs).reset_index(drop=True)
\ No newline at end of file
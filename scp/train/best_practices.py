@@ -1,6 +1,8 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: nb_train.best_practices.ipynb (unless otherwise specified).
 
-__all__ = ['LiuProcedure', 'LasserProcedure', 'ValleProcedure', 'XuProcedure', 'get_inference_tfms', 'get_train_tfms']
+__all__ = ['BatchTransform', 'BatchTranspose', 'BatchVerticalFlip', 'BatchHorizontalFlip', 'BatchRandomRotate90',
+           'BatchBrightnessContrast', 'BatchShiftScaleRotate', 'BatchCutout', 'BatchTransforms', 'LiuProcedure',
+           'LasserProcedure', 'ValleProcedure', 'XuProcedure', 'get_inference_tfms', 'get_train_tfms']
 
 # Cell
 import pandas as pd
@@ -8,10 +10,175 @@ import numpy as np
 import albumentations as A
 from albumentations.pytorch import ToTensorV2
 import torch
+from torch.utils.data.dataloader import default_collate
 from pl_bolts.optimizers.lr_scheduler import LinearWarmupCosineAnnealingLR
 import torch.nn.functional as F
+import math
 
 
+# Cell
+class BatchTransform(torch.nn.Module):
+    '''Base class of random transforms that are applied to whole batches of images (B, C, H, W)
+
+    Every image of a batch is transformed with probability ´p´ and with its own random parameters.
+    Subclasses implement ´apply´ which transforms all selected images at once.
+    '''
+    def __init__(self, p=0.5):
+        super().__init__()
+        self.p = p
+
+    def forward(self, imgs):
+        mask = torch.rand(len(imgs), device=imgs.device) < self.p
+        if mask.any():
+            imgs[mask] = self.apply(imgs[mask])
+        return imgs
+
+    def apply(self, imgs):
+        raise NotImplementedError
+
+    def extra_repr(self):
+        return f"p={self.p}"
+
+class BatchTranspose(BatchTransform):
+    '''Batched version of ´A.Transpose´ (only for square images)'''
+    def apply(self, imgs):
+        return imgs.transpose(2, 3)
+
+class BatchVerticalFlip(BatchTransform):
+    '''Batched version of ´A.VerticalFlip´'''
+    def apply(self, imgs):
+        return imgs.flip(2)
+
+class BatchHorizontalFlip(BatchTransform):
+    '''Batched version of ´A.HorizontalFlip´'''
+    def apply(self, imgs):
+        return imgs.flip(3)
+
+class BatchRandomRotate90(BatchTransform):
+    '''Batched version of ´A.RandomRotate90´ (only for square images)'''
+    def apply(self, imgs):
+        ks = torch.randint(0, 4, (len(imgs),), device=imgs.device)
+        out = imgs.clone()
+        for k in range(1, 4):
+            if (ks==k).any():
+                out[ks==k] = torch.rot90(imgs[ks==k], k, dims=(2, 3))
+        return out
+
+class BatchBrightnessContrast(BatchTransform):
+    '''Batched version of ´A.RandomBrightnessContrast´ (brightness by max value)
+
+    ´A.RandomBrightness´ and ´A.RandomContrast´ correspond to ´contrast_limit=0´ and ´brightness_limit=0´.
+    '''
+    def __init__(self, brightness_limit=0.2, contrast_limit=0.2, max_pixel_value=255., p=0.5):
+        super().__init__(p)
+        self.brightness_limit = brightness_limit
+        self.contrast_limit = contrast_limit
+        self.max_pixel_value = max_pixel_value
+
+    def apply(self, imgs):
+        shape = (len(imgs), 1, 1, 1)
+        alpha = 1 + (2*torch.rand(shape, device=imgs.device) - 1)*self.contrast_limit
+        beta = (2*torch.rand(shape, device=imgs.device) - 1)*self.brightness_limit*self.max_pixel_value
+        return (imgs*alpha + beta).clamp(0, self.max_pixel_value)
+
+class BatchShiftScaleRotate(BatchTransform):
+    '''Batched version of ´A.ShiftScaleRotate´ (bilinear interpolation with ´F.grid_sample´)
+
+    ´padding_mode´ is one of ´zeros´ (´border_mode=cv2.BORDER_CONSTANT´), ´border´ or
+    ´reflection´ (approximately the default ´border_mode=cv2.BORDER_REFLECT_101´).
+    '''
+    def __init__(self, shift_limit=0.0625, scale_limit=0.1, rotate_limit=45, padding_mode="reflection", p=0.5):
+        super().__init__(p)
+        self.shift_limit = shift_limit
+        self.scale_limit = scale_limit
+        self.rotate_limit = rotate_limit
+        self.padding_mode = padding_mode
+
+    def apply(self, imgs):
+        n, _, h, w = imgs.shape
+        uniform = lambda limit: (2*torch.rand(n, device=imgs.device) - 1)*limit
+        angle = uniform(self.rotate_limit)*math.pi/180
+        scale = 1 + uniform(self.scale_limit)
+        shift = torch.stack([uniform(self.shift_limit)*w, uniform(self.shift_limit)*h], dim=1) # pixels
+
+        # grid_sample needs the inverse mapping (output -> input) in normalized coordinates ([-1, 1])
+        cos, sin = torch.cos(angle), torch.sin(angle)
+        rot_inv = torch.stack([torch.stack([cos, sin], dim=1), torch.stack([-sin, cos], dim=1)], dim=1)
+        to_pixels = torch.diag(torch.tensor([w/2, h/2], device=imgs.device, dtype=imgs.dtype))
+        to_normalized = torch.diag(torch.tensor([2/w, 2/h], device=imgs.device, dtype=imgs.dtype))
+        mat = to_normalized @ rot_inv.to(imgs.dtype) / scale[:, None, None]
+        theta = torch.cat([mat @ to_pixels, -(mat @ shift[:, :, None].to(imgs.dtype))], dim=2)
+
+        grid = F.affine_grid(theta, imgs.shape, align_corners=False)
+        return F.grid_sample(imgs, grid, mode="bilinear", padding_mode=self.padding_mode, align_corners=False)
+
+class BatchCutout(BatchTransform):
+    '''Batched version of ´A.Cutout´'''
+    def __init__(self, max_h_size=8, max_w_size=8, num_holes=1, fill_value=0, p=0.5):
+        super().__init__(p)
+        self.max_h_size = max_h_size
+        self.max_w_size = max_w_size
+        self.num_holes = num_holes
+        self.fill_value = fill_value
+
+    def apply(self, imgs):
+        n, _, h, w = imgs.shape
+        rows = torch.arange(h, device=imgs.device)
+        cols = torch.arange(w, device=imgs.device)
+        for _ in range(self.num_holes):
+            # same hole placement as albumentations: random center, clipped at the image border
+            y1 = (torch.randint(0, h+1, (n, 1), device=imgs.device) - self.max_h_size//2).clamp(0, h)
+            x1 = (torch.randint(0, w+1, (n, 1), device=imgs.device) - self.max_w_size//2).clamp(0, w)
+            in_rows = (rows >= y1) & (rows < y1 + self.max_h_size)
+            in_cols = (cols >= x1) & (cols < x1 + self.max_w_size)
+            hole = in_rows[:, :, None] & in_cols[:, None, :]
+            imgs.masked_fill_(hole[:, None], self.fill_value)
+        return imgs
+
+class BatchTransforms(torch.nn.Module):
+    '''Apply a list of ´BatchTransform´s to a batch of uint8 images and normalize it
+
+    Parameters
+    ----------
+    tfms : list
+        List of ´BatchTransform´s applied in order
+
+    normalize : bool; optional
+        If True, images are normalized like with ´A.Normalize´
+
+    mean, std : tuple; optional
+        Same as for ´A.Normalize´
+
+    max_pixel_value : float; optional
+        Same as for ´A.Normalize´
+
+    Returns
+    -------
+    A float32 tensor (B, C, H, W) on the device of the input batch.
+    '''
+    def __init__(self, tfms=list(), normalize=True, mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225), max_pixel_value=255.):
+        super().__init__()
+        self.tfms = torch.nn.ModuleList(tfms)
+        self.normalize = normalize
+        self.max_pixel_value = max_pixel_value
+        self.register_buffer("mean", torch.tensor(mean, dtype=torch.float32).view(1, -1, 1, 1), persistent=False)
+        self.register_buffer("std", torch.tensor(std, dtype=torch.float32).view(1, -1, 1, 1), persistent=False)
+
+    def forward(self, imgs):
+        imgs = imgs.to(torch.float32, copy=True) # transforms work inplace
+        for tfm in self.tfms:
+            imgs = tfm(imgs)
+        if self.normalize:
+            # (imgs/max_pixel_value - mean)/std in a single pass
+            scale = 1/(self.max_pixel_value*self.std.to(imgs.device))
+            imgs = torch.addcmul(-self.mean.to(imgs.device)/self.std.to(imgs.device), imgs, scale)
+        return imgs
+
+    def collate(self, items):
+        '''Collate function for a ´DataLoader´ that transforms the images (first element of every item)'''
+        batch = default_collate(items)
+        return [self(batch[0])] + list(batch[1:])
+
 # Cell
 class LiuProcedure():
     '''Liu et al. (https://arxiv.org/abs/2010.05351)
@@ -113,6 +280,46 @@ class LiuProcedure():
             ToTensorV2(),
         ]
 
+    @staticmethod
+    def get_batched_transforms(img_size):
+        '''Get transforms for batched execution (see ´BatchTransforms´)
+
+        Flips and the transpose are moved behind the blurs and distortions (which are symmetric
+        in distribution) and ´ShiftScaleRotate´ behind the resize. Brightness and contrast have to
+        stay in front of CLAHE and are therefore kept per image.
+
+        Returns
+        -------
+        A list of albumentation transforms (returning uint8 tensors) and ´BatchTransforms´.
+        '''
+        item_tfms = [
+            A.RandomBrightness(limit=0.2, p=0.75),
+            A.RandomContrast(limit=0.2, p=0.75),
+            A.OneOf([
+                A.MotionBlur(blur_limit=5),
+                A.MedianBlur(blur_limit=5),
+                A.GaussianBlur(blur_limit=5),
+                A.GaussNoise(var_limit=(5.0, 30.0)),
+            ], p=0.7),
+            A.OneOf([
+                A.OpticalDistortion(distort_limit=1.0),
+                A.GridDistortion(num_steps=5, distort_limit=1.),
+                A.ElasticTransform(alpha=3),
+            ], p=0.7),
+            A.CLAHE(clip_limit=4.0, p=0.7),
+            A.HueSaturationValue(hue_shift_limit=10, sat_shift_limit=20, val_shift_limit=10, p=0.5),
+            A.Resize(img_size, img_size),
+            ToTensorV2(),
+        ]
+        batch_tfms = BatchTransforms([
+            BatchTranspose(p=0.5),
+            BatchVerticalFlip(p=0.5),
+            BatchHorizontalFlip(p=0.5),
+            BatchShiftScaleRotate(shift_limit=0.1, scale_limit=0.1, rotate_limit=15, padding_mode="zeros", p=0.85),
+            BatchCutout(max_h_size=int(img_size * 0.375), max_w_size=int(img_size * 0.375), num_holes=1, p=0.7),
+        ])
+        return item_tfms, batch_tfms
+
     @staticmethod
     def get_criterion():
         '''Get loss function'''
@@ -195,6 +402,25 @@ class LasserProcedure():
             ToTensorV2(),
         ]
 
+    @staticmethod
+    def get_batched_transforms(img_size):
+        '''Get transforms for batched execution (see ´BatchTransforms´)
+
+        All transforms after the resize are applied to whole batches in the same order.
+        '''
+        item_tfms = [
+            A.Resize(img_size, img_size),
+            ToTensorV2(),
+        ]
+        batch_tfms = BatchTransforms([
+            BatchVerticalFlip(p=0.5),
+            BatchHorizontalFlip(p=0.5),
+            BatchShiftScaleRotate(shift_limit=0.0625, scale_limit=0.5, rotate_limit=45, p=0.5),
+            BatchRandomRotate90(p=0.5),
+            BatchBrightnessContrast(p=0.5),
+        ])
+        return item_tfms, batch_tfms
+
 class ValleProcedure():
     '''Valle et al. (https://arxiv.org/abs/1809.01442)
 
@@ -239,8 +465,23 @@ def get_inference_tfms(img_size, normalize=True):
 
     return tfms
 
-def get_train_tfms(img_size, tfm_name):
-    '''Get train transforms'''
+def get_train_tfms(img_size, tfm_name, batched=False):
+    '''Get train transforms
+
+    If ´batched=True´, a tuple of per image albumentation transforms and ´BatchTransforms´
+    for the collated batch is returned (see ´LiuProcedure.get_batched_transforms´), e.g. for
+    ´DataFrameDataModule(..., transforms={"train": A.Compose(item_tfms)}, batch_tfms={"train": batch_tfms})´.
+    '''
+    if batched:
+        if tfm_name == "liu":
+            return LiuProcedure.get_batched_transforms(img_size)
+        elif tfm_name == "lasser":
+            return LasserProcedure.get_batched_transforms(img_size)
+        elif tfm_name in ["valle", "xu", "default"]:
+            return [A.Resize(img_size, img_size), ToTensorV2()], BatchTransforms()
+        else:
+            raise ValueError(f"Unknown transform name '{tfm_name}'")
+
     if tfm_name == "liu":
         return LiuProcedure.get_transforms(img_size)
     elif tfm_name == "lasser":
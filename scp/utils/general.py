@@ -1,7 +1,7 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: nb_utils.general.ipynb (unless otherwise specified).
 
-__all__ = ['load_config_yaml', 'p2t', 't2p', 'a2p', 'AggregatingHook', 'n_argmin', 'n_argmax', 'state_dicts_equal',
-           'convert_state_dict', 'custom_save', 'custom_load', 'zip_dir', 'isnotebook']
+__all__ = ['load_config_yaml', 'p2t', 't2p', 'a2p', 'AggregatingHook', 'StreamingHook', 'n_argmin', 'n_argmax',
+           'state_dicts_equal', 'convert_state_dict', 'custom_save', 'custom_load', 'zip_dir', 'isnotebook']
 
 # Cell
 import yaml
@@ -11,6 +11,7 @@ import PIL
 from pathlib import Path
 from fastai.vision.all import *
 import gc
+import math
 import torch
 from zipfile import ZipFile
 from os.path import basename
@@ -47,6 +48,128 @@ class AggregatingHook(Hook):
             input,output = to_detach(input, cpu=self.cpu, gather=self.gather),to_detach(output, cpu=self.cpu, gather=self.gather)
         self.stored.append(self.hook_func(module, input, output))
 
+# example - get output after feature extractor
+# learn = cnn_learner(dls, resnet50, pretrained=True)
+# hook = AggregatingHook(
+#     module = learn.model[1][1],
+#     hook_func = lambda m,i,o: o,
+#     cpu = True
+# )
+
+# _ = learn.get_preds()
+# preds = torch.cat(hook.stored)
+
+# Cell
+class StreamingHook(Hook):
+    '''Write hook outputs of every batch into one contiguous array instead of a list of tensors
+
+    Outputs are (optionally) reduced on the device of the module, converted to ´dtype´ and copied into
+    a preallocated buffer that grows by doubling, or into a memory-mapped .npy file. ´stored´ is a view
+    of the filled part of the buffer, hence no final concatenation is needed.
+
+    Parameters
+    ----------
+    m : nn.Module
+        Hooked module
+
+    hook_func : callable; optional
+        Applied to ´module´, ´input´, ´output´ (defaults to the output)
+
+    reduction : str or callable; optional
+        ´avg´ or ´max´ pool all dimensions after the channel dimension (e.g. spatial dims of CNN features),
+        ´cls´ keeps the first token of transformer outputs (batch, tokens, dim) or a callable. Outputs are
+        flattened to (batch, features) afterwards.
+
+    dtype : np.dtype; optional
+        Dtype of the stored features, e.g. ´np.float16´ to halve memory
+
+    proj_dim : int; optional
+        If set, features are reduced to ´proj_dim´ dimensions with a fixed gaussian random projection
+
+    n_items : int; optional
+        Expected number of items (e.g. length of the dataset) to preallocate the buffer. Required with ´path´.
+
+    path : str; optional
+        If set, features are written into a memory-mapped .npy file with ´n_items´ rows
+
+    seed : int; optional
+        Seed of the random projection
+    '''
+    def __init__(self, m, hook_func=None, reduction=None, dtype=np.float32, proj_dim=None, n_items=None,
+                 path=None, seed=0, is_forward=True, detach=True, gather=False):
+        if path is not None and n_items is None:
+            raise ValueError("´n_items´ is required to write into a memory-mapped file")
+        super().__init__(m, hook_func if hook_func is not None else (lambda m, i, o: o), is_forward, detach, False, gather)
+        self.reduction, self.dtype, self.proj_dim = reduction, np.dtype(dtype), proj_dim
+        self.n_items, self.path, self.seed = n_items, path, seed
+        self.torch_dtype = torch.from_numpy(np.empty(0, dtype=self.dtype)).dtype
+        self.proj = None
+        self.n = 0
+        self.buffer = None
+
+    @property
+    def stored(self):
+        '''All features written so far (a view, no copy)'''
+        return self.buffer[:self.n] if self.buffer is not None else None
+
+    @stored.setter
+    def stored(self, value):
+        pass # ´Hook.__init__´ initializes ´stored´, features are only written by ´hook_fn´
+
+    def reset(self):
+        '''Start writing from the beginning of the buffer again (e.g. for the next dataset)'''
+        self.n = 0
+
+    def _reduce(self, x):
+        if callable(self.reduction):
+            x = self.reduction(x)
+        elif self.reduction == "avg" and x.ndim > 2:
+            x = x.flatten(2).mean(dim=2)
+        elif self.reduction == "max" and x.ndim > 2:
+            x = x.flatten(2).amax(dim=2)
+        elif self.reduction == "cls":
+            x = x[:, 0]
+        x = x.flatten(1)
+        if self.proj_dim is not None:
+            if self.proj is None:
+                generator = torch.Generator().manual_seed(self.seed)
+                self.proj = torch.randn(x.shape[1], self.proj_dim, generator=generator) / math.sqrt(self.proj_dim)
+            self.proj = self.proj.to(x.device)
+            x = x.float() @ self.proj
+        return x
+
+    def _reserve(self, n, shape):
+        if self.buffer is None:
+            if self.path is not None:
+                self.buffer = np.lib.format.open_memmap(self.path, mode="w+", dtype=self.dtype, shape=(self.n_items,) + shape)
+            else:
+                self.buffer = np.empty((max(n, self.n_items or 0),) + shape, dtype=self.dtype)
+        if self.n + n > len(self.buffer):
+            if self.path is not None:
+                raise ValueError(f"More than ´n_items´={len(self.buffer)} items were written to {self.path}")
+            buffer = np.empty((max(self.n + n, 2*len(self.buffer)),) + self.buffer.shape[1:], dtype=self.dtype)
+            buffer[:self.n] = self.buffer[:self.n]
+            self.buffer = buffer
+
+    def hook_fn(self, module, input, output):
+        "Applies `hook_func` to `module`, `input`, `output` and writes the (reduced) result into the buffer."
+        if self.detach:
+            input,output = to_detach(input, cpu=False, gather=self.gather),to_detach(output, cpu=False, gather=self.gather)
+        x = self._reduce(self.hook_func(module, input, output))
+        x = x.to("cpu", dtype=self.torch_dtype).numpy()
+        self._reserve(len(x), x.shape[1:])
+        self.buffer[self.n:self.n + len(x)] = x
+        self.n += len(x)
+
+    def flush(self):
+        '''Write a memory-mapped buffer to disk'''
+        if isinstance(self.buffer, np.memmap):
+            self.buffer.flush()
+
+# example - pooled fp16 features of a whole dataset
+# hook = StreamingHook(learn.model[0], reduction="avg", dtype=np.float16, n_items=len(dls.valid_ds))
+# _ = learn.get_preds()
+# feats = hook.stored
 
 # Cell
 def n_argmin(arr:np.array, n:int):